@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""Measure how many bytes each RedditComment costs to hold in memory.
+
+Compares the old layout (every field copied into the instance __dict__, a RedditUser for every user field, plus raw)
+with the current __slots__ layout: untouched, with every field read, and after drop_raw().
+
+	python3 benchmarks/bench_memory.py [count]
+
+Prints a JSON object of bytes per comment for each layout."""
+
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lightreddit
+
+class LegacyUser:
+	def __init__(self, session, name):
+		self.session = session
+		self.kind = "t2"
+		self.name = name
+		self.null_user = name == None or name[0] == "#"
+
+class LegacyComment:
+	"""RedditComment as it was built before fields became lazy"""
+
+	fields = lightreddit.RedditComment.fields
+	user_fields = lightreddit.RedditComment.user_fields
+
+	def __init__(self, session, data):
+		self.session = session
+		self.kind = data["kind"]
+		for k in self.fields:
+			if k in data["data"]:
+				setattr(self, k, data["data"][k])
+		for k in self.user_fields:
+			if k in data["data"]:
+				setattr(self, k, LegacyUser(session, data["data"][k]))
+		self.raw = data
+		self.replies = []
+
+def payload(count):
+	"""JSON for count comments, with roughly the keys reddit.com sends"""
+	extra = ["subreddit_id", "approved_at_utc", "ups", "mod_reason_by", "removal_reason", "likes", "user_reports", "saved", "archived", "no_follow", "can_mod_post", "send_replies", "score", "author_fullname", "collapsed", "body_html", "gildings", "collapsed_reason", "author_premium", "permalink", "subreddit_type", "locked", "report_reasons", "created", "score_hidden", "controversiality", "depth", "mod_reports", "subreddit_name_prefixed", "downs", "is_submitter", "stickied", "total_awards_received"]
+	items = []
+	for i in range(count):
+		d = {"id": "c%05d" % i, "name": "t1_c%05d" % i, "body": "comment body number %d, " % i * 4, "edited": False, "created_utc": 1500000000.0 + i,
+			"num_reports": None, "subreddit": "python", "link_id": "t3_abc", "link_title": "a thread", "parent_id": "t3_abc",
+			"author": "user%d" % (i % 500), "link_author": "op", "banned_by": None, "approved_by": None, "replies": ""}
+		for k in extra:
+			d[k] = "%s-%d" % (k, i) if k.endswith("html") else i
+		items.append({"kind": "t1", "data": d})
+	return json.dumps(items).encode()
+
+def measure(body, build):
+	"""Bytes still allocated per object once only the objects (not the decoded list) are referenced"""
+	gc.collect()
+	tracemalloc.start()
+	items = json.loads(body)
+	things = [build(x) for x in items]
+	del items
+	gc.collect()
+	used = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return used / len(things)
+
+def touch(t):
+	for k in t.fields + t.user_fields:
+		getattr(t, k, None)
+	return t
+
+def dropped(t):
+	t.drop_raw()
+	return t
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	body = payload(count)
+	results = {
+		"count": count,
+		"legacy": measure(body, lambda x: LegacyComment(None, x)),
+		"slots_untouched": measure(body, lambda x: lightreddit.RedditComment(None, x)),
+		"slots_all_fields_read": measure(body, lambda x: touch(lightreddit.RedditComment(None, x))),
+		"slots_drop_raw": measure(body, lambda x: dropped(lightreddit.RedditComment(None, x))),
+	}
+	print(json.dumps(results, indent=1))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""Benchmark RedditSession against the local stand-in server in stub_server.py.
+
+Covers _get_listing, _get_listing_backwards, get_thread (with morechildren), get_modlog, get_flairlist
+and _thing_factory on its own, and records wall time, CPU time, requests, requests per second and peak
+memory for each. Results are printed (or written with --output) as JSON, so two releases can be diffed.
+
+	python3 benchmarks/bench_session.py --latency 0.02 --output before.json"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lightreddit
+from stub_server import StubReddit
+
+def make_session(base_url, paced):
+	"""A session pointed at the stub. Unless paced, it doesn't wait between requests, so the numbers show the library's own cost."""
+	limiter = lightreddit.RateLimiter() if paced else lightreddit.RateLimiter(interval=0, reserve=0)
+	s = lightreddit.RedditSession("bench", "bench", "lightreddit benchmark", "bench", "bench", token_cache=False, cache=False, ratelimiter=limiter)
+	s.url_base = base_url
+	return s
+
+def scenarios(stub):
+	start = stub.comments[1000]["data"]["name"]	#1000 items behind the front
+	page = json.loads(json.dumps(stub.listing(stub.comments, {"limit":100})))
+	return {
+		"listing_backwards": lambda s: len(s._get_listing_backwards("comments", "bench")),
+		"listing_forward": lambda s: len(s._get_listing("comments", "bench", start)),
+		"thread": lambda s: _count(s.get_thread("bench").comments),
+		"thread_workers4": lambda s: _count(s.get_thread("bench", workers=4).comments),
+		"modlog": lambda s: len(s.get_modlog("bench")),
+		"flairlist": lambda s: len(s.get_flairlist("bench")),
+		"thing_factory": lambda s: sum(1 for i in range(100) for x in page["data"]["children"] if s._thing_factory(x) is not None),
+	}
+
+def _count(comments):
+	n = 0
+	stack = list(comments)
+	while stack:
+		c = stack.pop()
+		n += 1
+		stack += c.replies
+	return n
+
+def run(name, f, stub, base_url, paced, repeat):
+	"""Time f repeat times and report the best run, then run it once more under tracemalloc for peak memory"""
+	best = None
+	for i in range(repeat):
+		s = make_session(base_url, paced)
+		requests_before = stub.requests
+		bytes_before = stub.bytes_sent
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		items = f(s)
+		wall = time.perf_counter() - wall
+		cpu = time.process_time() - cpu
+		r = {"items":items, "requests":stub.requests - requests_before, "bytes":stub.bytes_sent - bytes_before, "wall_s":round(wall, 4), "cpu_s":round(cpu, 4)}
+		r["requests_per_s"] = round(r["requests"] / wall, 1) if r["requests"] and wall > 0 else None
+		s.close()
+		if best is None or r["wall_s"] < best["wall_s"]:
+			best = r
+	s = make_session(base_url, paced)
+	tracemalloc.start()
+	f(s)
+	best["peak_mem_bytes"] = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	s.close()
+	return best
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub waits before each response")
+	parser.add_argument("--ratelimit", type=int, nargs=2, metavar=("REQUESTS", "SECONDS"), help="have the stub send X-Ratelimit-* headers and pace the session by them")
+	parser.add_argument("--thread-size", type=int, default=5000)
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--fixtures", help="directory of recorded responses for the stub to serve")
+	parser.add_argument("--only", action="append", help="run only this scenario (can be repeated)")
+	parser.add_argument("--output", help="write the results here instead of stdout")
+	args = parser.parse_args()
+
+	stub = StubReddit(latency=args.latency, ratelimit=args.ratelimit, thread_size=args.thread_size, fixtures=args.fixtures)
+	base_url = stub.start()
+	try:
+		results = {}
+		for name, f in scenarios(stub).items():
+			if args.only and name not in args.only:
+				continue
+			results[name] = run(name, f, stub, base_url, args.ratelimit is not None, args.repeat)
+	finally:
+		stub.stop()
+
+	out = {
+		"meta":{"python":platform.python_version(), "json":lightreddit._json_loads.__module__, "latency":args.latency, "ratelimit":args.ratelimit, "thread_size":args.thread_size, "repeat":args.repeat, "time":int(time.time())},
+		"results":results,
+	}
+	text = json.dumps(out, indent=1, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+	else:
+		print(text)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+"""A local stand-in for reddit.com, for benchmarking lightreddit without touching the network.
+
+Serves synthetic (or recorded) JSON for the endpoints in RedditSession.urls that the benchmarks use:
+listings (comments, submissions, modlog, user pages), threads with many "more" stubs, morechildren,
+api/info, flairlist and flaircsv, plus api/v1/access_token. Responses can be delayed by a fixed latency, and
+X-Ratelimit-* headers (with 429s once the budget runs out) can be switched on.
+
+	stub = StubReddit(latency=0.05)
+	session.url_base = stub.start()
+	...
+	stub.stop()
+
+Run it directly to serve on a fixed port: python3 benchmarks/stub_server.py --port 8080"""
+
+import argparse
+import csv
+import gzip
+import http.server
+import io
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+def b36(n):
+	digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+	s = ""
+	while n:
+		n, r = divmod(n, 36)
+		s = digits[r] + s
+	return s or "0"
+
+class StubReddit():
+	"""The stand-in server. Everything it serves is generated from seed, so runs are repeatable.
+	If fixtures is a directory, a request for /a/b/c.json is answered with fixtures/a_b_c.json when that file exists (the query string is ignored)."""
+
+	def __init__(self, latency=0.0, ratelimit=None, listing_size=3000, thread_size=5000, thread_shown=200, flair_size=20000, fixtures=None, compress=True, seed=1):
+		self.latency = latency				#seconds added to every response
+		self.ratelimit = ratelimit			#(requests, window seconds), or None for no X-Ratelimit-* headers
+		self.fixtures = fixtures
+		self.compress = compress			#gzip responses when the client accepts it, like reddit.com does
+		self.requests = 0
+		self.bytes_sent = 0
+		self.window_start = time.time()
+		self.window_used = 0
+		self.lock = threading.Lock()
+		self.server = None
+		rnd = random.Random(seed)
+		self.comments = [self._comment(i, "t3_bench", "t3_bench", rnd) for i in range(listing_size, 0, -1)]	#newest first, like a listing
+		self.modlog = [self._modaction(i, rnd) for i in range(listing_size, 0, -1)]
+		self.flair = [{"user":"user%d" % i, "flair_text":"flair %d" % (i % 50), "flair_css_class":"c%d" % (i % 7)} for i in range(flair_size)]
+		self._build_thread(thread_size, thread_shown, rnd)
+		self.positions = {}
+		for listing in (self.comments, self.modlog):
+			for i, item in enumerate(listing):
+				self.positions[item["data"]["name"]] = i
+
+	@staticmethod
+	def _comment(i, link_id, parent_id, rnd):
+		return {"kind":"t1", "data":{"id":b36(i), "name":"t1_" + b36(i), "body":"comment %d " % i * rnd.randint(1, 12), "author":"user%d" % rnd.randint(0, 500),
+			"created_utc":1500000000.0 + i, "edited":False, "score":rnd.randint(-5, 500), "num_reports":None, "subreddit":"bench", "subreddit_id":"t5_bench",
+			"link_id":link_id, "link_title":"benchmark thread", "link_author":"op", "parent_id":parent_id, "banned_by":None, "approved_by":None,
+			"permalink":"/r/bench/comments/bench/_/%s/" % b36(i), "ups":1, "downs":0, "gilded":0, "stickied":False, "replies":""}}
+
+	@staticmethod
+	def _modaction(i, rnd):
+		id = "ModAction_%s" % (uuid.UUID(int=random.Random("modaction%d" % i).getrandbits(128), version=1))	#shaped like reddit.com's, and not base36 (ModAction_00000001 would parse as one)
+		return {"kind":"modaction", "data":{"id":id, "name":id, "created_utc":1500000000.0 + i, "subreddit":"bench",
+			"mod":"mod%d" % rnd.randint(0, 5), "action":rnd.choice(["removecomment", "approvelink", "banuser", "editflair"]), "details":"", "description":"",
+			"target_fullname":"t1_" + b36(i)}}
+
+	def _build_thread(self, size, shown, rnd):
+		"""A random comment tree. The thread listing shows the first shown comments; the rest are behind "more" stubs."""
+		self.parents = {}
+		self.kids = {0: []}
+		for i in range(1, size + 1):
+			p = 0 if i == 1 or rnd.random() < 0.15 else rnd.randint(max(1, i - 60), i - 1)
+			self.parents[i] = p
+			self.kids.setdefault(p, []).append(i)
+		self.thread_shown = shown
+		self.sizes = {}	#comment -> how many comments are in its subtree, worked out as needed
+		self.deleted = set()	#comments that are left out of the thread and morechildren but still counted in "more" stubs, like deleted ones on reddit.com
+
+	def add_comment(self, parent):
+		"""Post a new comment to the thread under comment parent (0 for top level) and return its id number"""
+		i = max(self.parents) + 1
+		self.parents[i] = parent
+		self.kids.setdefault(parent, []).append(i)
+		self.sizes = {}
+		return i
+
+	def _size(self, i):
+		if i not in self.sizes:
+			n = 0
+			stack = [i]
+			while stack:
+				j = stack.pop()
+				n += 1
+				stack.extend(self.kids.get(j, []))
+			self.sizes[i] = n
+		return self.sizes[i]
+
+	def _thread_comment(self, i):
+		rnd = random.Random(i)
+		p = self.parents[i]
+		return self._comment(i, "t3_bench", "t1_" + b36(p) if p else "t3_bench", rnd)
+
+	def _more(self, parent, ids):
+		return {"kind":"more", "data":{"id":b36(ids[0]), "name":"t1_" + b36(ids[0]), "count":sum(self._size(i) for i in ids), "parent_id":parent, "depth":0, "children":[b36(i) for i in ids]}}	#like reddit.com, count is everything under the stub
+
+	def _thread_listing(self, parent, budget):
+		children = []
+		ids = self.kids.get(parent, [])
+		for j, i in enumerate(ids):
+			if i in self.deleted:
+				continue
+			if budget[0] <= 0:
+				children.append(self._more("t1_" + b36(parent) if parent else "t3_bench", ids[j:]))
+				break
+			budget[0] -= 1
+			c = self._thread_comment(i)
+			replies = self._thread_listing(i, budget)
+			c["data"]["replies"] = {"kind":"Listing", "data":{"children":replies}} if replies else ""
+			children.append(c)
+		return children
+
+	def thread(self):
+		submission = {"kind":"t3", "data":{"id":"bench", "name":"t3_bench", "title":"benchmark thread", "subreddit":"bench", "author":"op", "created_utc":1500000000.0,
+			"is_self":True, "selftext":"", "domain":"self.bench", "url":"", "permalink":"/r/bench/comments/bench/", "num_reports":None}}
+		return [{"kind":"Listing", "data":{"children":[submission]}}, {"kind":"Listing", "data":{"children":self._thread_listing(0, [self.thread_shown])}}]
+
+	def morechildren(self, ids):
+		things = []
+		for i in ids:
+			if i in self.deleted:
+				continue
+			c = self._thread_comment(i)
+			things.append(c)
+			if self.kids.get(i):
+				things.append(self._more(c["data"]["name"], self.kids[i]))
+		return {"json":{"errors":[], "data":{"things":things}}}
+
+	def listing(self, items, q):
+		limit = int(q.get("limit", 25))
+		if q.get("before"):
+			end = self.positions.get(q["before"], 0)
+			page = items[max(0, end - limit):end]
+		else:
+			start = self.positions[q["after"]] + 1 if q.get("after") else 0
+			page = items[start:start + limit]
+		after = page[-1]["data"]["name"] if page and page[-1] is not items[-1] else None
+		return {"kind":"Listing", "data":{"children":page, "after":after, "before":None}}
+
+	def flairlist(self, q):
+		limit = int(q.get("limit", 1000))
+		start = int(q["after"]) if q.get("after") else 0
+		a = {"users":self.flair[start:start + limit]}
+		if start + limit < len(self.flair):
+			a["next"] = str(start + limit)
+		return a
+
+	def flaircsv(self, q):
+		"""Apply a flaircsv upload to the flairlist and answer with one result per row, like reddit.com"""
+		index = {f["user"].lower(): f for f in self.flair}
+		results = []
+		for user, text, css in csv.reader(io.StringIO(q.get("flair_csv", ""))):
+			f = index.get(user.lower())
+			if text == "" and css == "":
+				if f is not None:
+					self.flair.remove(f)
+				results.append({"ok":True, "status":"removed flair for user %s" % (user), "errors":{}, "warnings":{}})
+				continue
+			if f is None:
+				f = index[user.lower()] = {"user":user}
+				self.flair.append(f)
+			f["flair_text"] = text
+			f["flair_css_class"] = css
+			results.append({"ok":True, "status":"added flair for user %s" % (user), "errors":{}, "warnings":{}})
+		return results
+
+	def info(self, q):
+		found = []
+		for f in q.get("id", "").split(","):
+			if f.startswith("t1_") and f[3:] and int(f[3:], 36) in self.parents:
+				found.append(self._thread_comment(int(f[3:], 36)))
+		return {"kind":"Listing", "data":{"children":found}}
+
+	def route(self, method, path, q):
+		"""Return (status, JSON-able body) for a request"""
+		if self.fixtures:
+			f = os.path.join(self.fixtures, path.strip("/").replace("/", "_"))
+			if os.path.exists(f):
+				with open(f, "rb") as fh:
+					return 200, fh.read()
+		if path == "/api/v1/access_token":
+			return 200, {"access_token":"stub-token", "token_type":"bearer", "expires_in":3600, "scope":"*"}
+		if path.startswith("/comments/"):
+			return 200, self.thread()
+		if path == "/api/morechildren.json":
+			return 200, self.morechildren([int(c, 36) for c in q["children"].split(",") if c])
+		if path == "/api/info.json":
+			return 200, self.info(q)
+		if path.endswith("/api/flairlist.json"):
+			return 200, self.flairlist(q)
+		if path.endswith("/api/flaircsv"):
+			return 200, self.flaircsv(q)
+		if path.endswith("/about/log.json"):
+			return 200, self.listing(self.modlog, q)
+		if path.endswith(".json") and (path.startswith("/r/") or path.startswith("/user/")):
+			return 200, self.listing(self.comments, q)
+		if method == "POST":
+			return 200, {"json":{"errors":[], "data":{}}}
+		return 404, {"error":404}
+
+	def ratelimit_headers(self):
+		"""Count a request against the budget and return (headers, whether it's over budget)"""
+		if self.ratelimit is None:
+			return {}, False
+		budget, window = self.ratelimit
+		with self.lock:
+			now = time.time()
+			if now - self.window_start >= window:
+				self.window_start = now
+				self.window_used = 0
+			self.window_used += 1
+			reset = int(self.window_start + window - now) + 1
+			headers = {"X-Ratelimit-Used":str(self.window_used), "X-Ratelimit-Remaining":str(max(budget - self.window_used, 0)), "X-Ratelimit-Reset":str(reset)}
+			if self.window_used > budget:
+				headers["Retry-After"] = str(reset)
+				return headers, True
+		return headers, False
+
+	def start(self, port=0):
+		"""Start serving in a background thread and return the base URL to use as RedditSession.url_base"""
+		stub = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"	#keep-alive, like reddit.com
+			disable_nagle_algorithm = True	#headers and body are written separately. don't let delayed ACKs stall every response
+
+			def do_GET(self):
+				self.answer("GET", {})
+
+			def do_POST(self):
+				length = int(self.headers.get("Content-Length", 0))
+				self.answer("POST", dict(urllib.parse.parse_qsl(self.rfile.read(length).decode())))
+
+			def answer(self, method, form):
+				u = urllib.parse.urlsplit(self.path)
+				q = dict(urllib.parse.parse_qsl(u.query, keep_blank_values=True), **form)
+				if stub.latency:
+					time.sleep(stub.latency)
+				headers, over = stub.ratelimit_headers()
+				if over:
+					status, body = 429, {"error":429}
+				else:
+					status, body = stub.route(method, u.path, q)
+				if not isinstance(body, bytes):
+					body = json.dumps(body).encode()
+				if stub.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+					body = gzip.compress(body, 1)
+					headers["Content-Encoding"] = "gzip"
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json; charset=UTF-8")
+				self.send_header("Content-Length", str(len(body)))
+				for k, v in headers.items():
+					self.send_header(k, v)
+				self.end_headers()
+				self.wfile.write(body)
+				with stub.lock:
+					stub.requests += 1
+					stub.bytes_sent += len(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, name="stub-reddit", daemon=True).start()
+		return "http://127.0.0.1:%d/" % (self.server.server_address[1])
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay each response")
+	parser.add_argument("--ratelimit", type=int, nargs=2, metavar=("REQUESTS", "SECONDS"), help="send X-Ratelimit-* headers for this budget")
+	parser.add_argument("--fixtures", help="directory of recorded responses")
+	args = parser.parse_args()
+	stub = StubReddit(latency=args.latency, ratelimit=args.ratelimit, fixtures=args.fixtures)
+	print("serving on %s" % (stub.start(args.port)))
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		stub.stop()
+
+if __name__ == "__main__":
+	main()
@@ -2,14 +2,41 @@
 
 import time
 import os
+import sys
 import requests
+import requests.adapters
+import urllib3.exceptions
 import urllib.parse
 import json
+try:
+	import orjson
+	_json_loads = orjson.loads	#several times faster on big listings
+except ImportError:
+	_json_loads = json.loads	#the stdlib takes bytes too
+import tempfile
+import contextlib
+import threading
+import asyncio
+import functools
+import concurrent.futures
+import collections
+import hashlib
+import queue
+import itertools
+import random
+import sqlite3
+import array
+import csv
+import io
+try:
+	import fcntl
+except ImportError:
+	fcntl = None	#not available on Windows. The token cache and SharedRateLimiter still work there, just without locking.
 
 class RedditSession():
 	"""
 	Usage:
-		First, create a RedditSession object. Then the following public methods are available:
+		First, create a RedditSession object (or use it in a with block so its connections get closed). Then the following public methods are available:
 
 		get_comments()
 		get_submissions()
@@ -18,21 +45,29 @@ class RedditSession():
 		and more
 
 		There is no login() method. Logging in is done lazily, as needed.
+
+		Responses from endpoints with a "cache" entry in urls (seconds to keep them) are served from the session's ResponseCache while they're fresh.
+
+		With an archive (a ThingArchive), every thing the session builds is also stored locally. sync_comments() etc. fetch only what's new since the last sync, and get_archived() queries the archive without touching reddit.com.
 	"""
+	#"idempotent" writes can be sent again without doing anything twice, so ActionScheduler retries them after any transient failure
 	urls = {
 		"comments":		{"url":"r/$r/comments.json",			"auth":False,	"args":{},							"method":"get",	"host":"www"},
 		"submissions":	{"url":"r/$r/new.json",					"auth":False,	"args":{},							"method":"get",	"host":"www"},
 		"thread":		{"url":"comments/$r.json",				"auth":False,	"args":{},							"method":"get",	"host":"www"},
 		"morechildren":{"url":"api/morechildren.json",		"auth":False,	"args":{"api_type":"json"},	"method":"get",	"host":"www"},
+		"info":			{"url":"api/info.json",					"auth":True,	"args":{},							"method":"get"},	#auth, so moderators see reports
+		"info_public":	{"url":"api/info.json",					"auth":False,	"args":{},							"method":"get",	"host":"www"},	#for single lookups, which don't need to log in
 
-		"report":		{"url":"api/report.json",				"auth":True,	"args":{},							"method":"post"},
-		"remove":		{"url":"api/remove.json",				"auth":True,	"args":{},							"method":"post"},
+		"report":		{"url":"api/report.json",				"auth":True,	"args":{},							"method":"post",	"idempotent":True},
+		"remove":		{"url":"api/remove.json",				"auth":True,	"args":{},							"method":"post",	"idempotent":True},
 		"reply":			{"url":"api/comment.json",				"auth":True,	"args":{"api_type":"json"},	"method":"post"},
-		"distinguish":	{"url":"api/distinguish.json",		"auth":True,	"args":{},							"method":"post"},
+		"distinguish":	{"url":"api/distinguish.json",		"auth":True,	"args":{},							"method":"post",	"idempotent":True},
 		"submit":		{"url":"api/submit.json",				"auth":True,	"args":{"api_type":"json"},	"method":"post"},
 
 		"modlog":		{"url":"r/$r/about/log.json",			"auth":True,	"args":{},							"method":"get"},
-		"flairlist":	{"url":"r/$r/api/flairlist.json",	"auth":True,	"args":{},							"method":"get"},
+		"flairlist":	{"url":"r/$r/api/flairlist.json",	"auth":True,	"args":{},							"method":"get"},	#not cached: it's streamed page by page, and update_flair() has to diff against the live list
+		"flaircsv":		{"url":"r/$r/api/flaircsv",			"auth":True,	"args":{},							"method":"post",	"idempotent":True},
 
 		"overview":		{"url":"user/$r/overview.json",		"auth":False,	"args":{},							"method":"get"},
 		"u_comments":	{"url":"user/$r/comments.json",		"auth":False,	"args":{},							"method":"get",	"host":"www"},
@@ -45,36 +80,118 @@ class RedditSession():
 
 		"compose":		{"url":"api/compose.json",				"auth":True,	"args":{"api_type":"json"},	"method":"post"},
 
-		"mysubs":		{"url":"subreddits/mine/subscriber.json",	"auth":True,	"args":{},					"method":"get"},
-		"mymods":		{"url":"subreddits/mine/moderator.json",	"auth":True,	"args":{},					"method":"get"},
+		"mysubs":		{"url":"subreddits/mine/subscriber.json",	"auth":True,	"args":{},					"method":"get",	"cache":600},
+		"mymods":		{"url":"subreddits/mine/moderator.json",	"auth":True,	"args":{},					"method":"get",	"cache":600},
 
 		"banned":		{"url":"r/$r/about/banned.json",		"auth":True,	"args":{},							"method":"get"},
-		"ban":			{"url":"api/friend",						"auth":True,	"args":{"type":"banned"},		"method":"post"},
-		"unban":			{"url":"api/unfriend",					"auth":True,	"args":{"type":"banned"},		"method":"post"},
-		"about":			{"url":"r/$r/about.json",				"auth":False,	"args":{},							"method":"get"},
-		"edit":			{"url":"r/$r/about/edit.json",		"auth":True,	"args":{},							"method":"get"},
+		"ban":			{"url":"api/friend",						"auth":True,	"args":{"type":"banned"},		"method":"post",	"idempotent":True},
+		"unban":			{"url":"api/unfriend",					"auth":True,	"args":{"type":"banned"},		"method":"post",	"idempotent":True},
+		"about":			{"url":"r/$r/about.json",				"auth":False,	"args":{},							"method":"get",	"cache":300},
+		"edit":			{"url":"r/$r/about/edit.json",		"auth":True,	"args":{},							"method":"get",	"cache":300},
 		"site_admin":	{"url":"api/site_admin",				"auth":True,	"args":{"api_type":"json"},	"method":"post"},
 
+		"wiki":			{"url":"r/$r.json",						"auth":False,	"args":{},							"method":"get",	"host":"www",	"cache":300},	#rname is "subreddit/wiki/page"
 		"wiki_write":	{"url":"r/$r/api/wiki/edit",			"auth":True,	"args":{},							"method":"post"}
 	}
 
 	_listing_batch = 100			#fetch this many listings at a time
 	_listing_limit = 1500		#fetch this many listings total
-	_morechildren_limit = 2		#fetch this many hidden children at a time	#TODO start this higher and cut it by half (and restart action) every time a t1__ error pops up
-		#TODO or maybe just leave things clumpted together the way they appear in the Mores
-
-	def __init__(self, u, p, agent, client_id, client_secret):
-		self.next_req_time = time.time() + 2
+	_morechildren_limit = 100	#fetch up to this many hidden children at a time (the API maximum). batches reddit.com rejects are split in half and retried
+	_info_batch = 100				#look up this many fullnames at a time with api/info (the API maximum)
+	_pool_size = 10				#keep up to this many connections open per host
+	_url_base = "https://$h.reddit.com/"	#$h is the host (www or oauth). point url_base at a stand-in server for testing
+	_token_refresh_margin = 120	#get a new access token this many seconds before the old one expires
+	_ratelimit_retries = 3		#resend a request this many times after a 429 before giving up
+	_transient_retries = 3		#resend a read this many times after a connection error or 502/503/504 before giving up
+	_retry_backoff = 1.0			#seconds to wait before the first of those retries. doubled (with jitter) for each one after
+	_transient_statuses = (502, 503, 504)	#not 500, which morechildren uses for batches it won't answer
+	_history_ttl = 300			#get_user_histories() reuses a user's history for this many seconds before asking for what's new
+	_history_cache_size = 500	#remember this many (user, kind) histories
+	_flairlist_batch = 1000		#fetch this many flair entries at a time (the API maximum)
+	_flaircsv_batch = 100		#set this many users' flair per request (the API maximum)
+
+	def __init__(self, u, p, agent, client_id, client_secret, pool_size=_pool_size, token_cache=True, ratelimiter=None, keep_raw=True, cache=True, archive=None, retries=_transient_retries):
+		"""token_cache can be a TokenCache, True (use the default one in this user's cache directory, if it can be made), or False (don't cache tokens)
+		ratelimiter can be anything with RateLimiter's wait() and update() methods. By default each session gets its own RateLimiter.
+		ratelimiter="shared" uses a SharedRateLimiter instead, so every session on this host with the same client_id and user draws from one budget.
+		Writes can be queued on the session's ActionScheduler (actions) instead of waiting for them; see RedditThing.remove() etc.
+		If keep_raw is False, things don't keep the JSON they were built from (see RedditThing.drop_raw()), which saves memory when holding many of them.
+		cache can be a ResponseCache, True (a default in-memory one), or False (always go to reddit.com).
+		archive can be a ThingArchive, the path of an SQLite file to archive to, or None (don't archive).
+		Reads that fail with a connection error or a 502/503/504 are retried up to retries times, with jittered exponential backoff. Listings and threads that still fail raise IncompleteFetchException, which can be resumed from."""
+		self.keep_raw = keep_raw
+		self.retries = retries
+		self.oauth_reads = False	#if set, reads that don't need auth are sent to oauth.reddit.com with our token anyway, so they count against our own budget. see RedditSessionPool
+		self.url_base = RedditSession._url_base
+		if ratelimiter == "shared":
+			ratelimiter = SharedRateLimiter(client_id, u)
+		self.ratelimiter = ratelimiter if ratelimiter is not None else RateLimiter()
 		self.tokens = {}
 		self.user = u
 		self.passwd = p
 		self.user_agent = agent + " [python-lightreddit]"
 		self.client_id = client_id
 		self.client_secret = client_secret
+		self.http = self._make_http(pool_size)
+		self.actions = ActionScheduler(self)	#its threads start with the first queued action
+		self.hooks = []			#see add_hook()
+		self.metrics = None		#see enable_metrics()
+		if token_cache is True:
+			try:
+				token_cache = TokenCache()
+			except OSError:	#no private directory to keep tokens in. log in every time instead
+				token_cache = None
+		self.token_cache = token_cache or None
+		if cache is True:
+			cache = ResponseCache()
+		self.cache = cache or None
+		if isinstance(archive, str):
+			archive = ThingArchive(archive)
+		self.archive = archive
+		self.histories = collections.OrderedDict()	#see get_user_histories()
+		self.histories_lock = threading.Lock()
+		self.token_lock = threading.Lock()		#held while checking or getting the access token, so only one thread logs in
+		self.inflight = {}							#GETs in progress -> Future of their decoded response, so identical ones share it
+		self.inflight_lock = threading.Lock()
+
+	def _make_http(self, pool_size):
+		"""Build the keep-alive connection pool that every request goes through"""
+		http = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)	#one pool per host (www, oauth, api)
+		http.mount("https://", adapter)
+		http.mount("http://", adapter)
+		http.headers["Accept-Encoding"] = "gzip, deflate"	#requests decodes these transparently
+		return http
+
+	def close(self):
+		"""Wait for queued actions to go out, then close all pooled connections. The session can still be used afterwards; it will just reconnect."""
+		self.actions.close()
+		self.http.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
 
 	def _login(self):
-		"""Log in to reddit. Use the stored cookie if possible."""
-		self._get_access_token()	#TODO re-use if possible
+		"""Log in to reddit. Re-use a cached access token if there's one that is still good."""
+		if self.token_cache:
+			t = self.token_cache.get(self.client_id, self.user)
+			if t and t["expires"] - time.time() > RedditSession._token_refresh_margin:
+				self.tokens = t
+				return
+		self._get_access_token()
+
+	def _token_is_fresh(self):
+		"""True if we have an access token that won't expire soon"""
+		return self.tokens != {} and self.tokens["expires"] - time.time() > RedditSession._token_refresh_margin
+
+	def _invalidate_token(self):
+		"""Forget the current access token (here and in the token cache), e.g. because reddit.com rejected it"""
+		if self.token_cache and self.tokens != {}:
+			self.token_cache.discard(self.client_id, self.user, self.tokens["bearer"])
+		self.tokens = {}
 
 	def  _get_access_token(self):
 		data = {
@@ -82,222 +199,519 @@ class RedditSession():
 			'username':		self.user,
 			'password':		self.passwd
 		}
-		y = self.req_raw('https://www.reddit.com/api/v1/access_token', args=data, auth=(self.client_id, self.client_secret), method='post')
-		response = json.loads(y.text)
-		self.tokens['bearer'] = response['access_token']
-		#TODO save in temp file
-
-	def req(self, url_name, rname="", args={}, get_args=None):
-		"""Build a request, send it through the dispatcher, and return the response body"""
+		y = self.req_raw(self.url_base.replace("$h", "www") + 'api/v1/access_token', args=data, auth=(self.client_id, self.client_secret), method='post', priority=ActionScheduler.URGENT)	#everything that needs auth is waiting on this
+		response = _json_loads(y.content)
+		if "access_token" not in response:	#reddit.com returns 200 with an error body for bad credentials
+			raise RuntimeError("login failed: %s" % (response.get("error", response)))
+		self.tokens = {"bearer": response["access_token"], "expires": time.time() + response.get("expires_in", 3600)}
+		if self.token_cache:
+			self.token_cache.put(self.client_id, self.user, self.tokens)
+
+	def add_hook(self, f):
+		"""Call f(event) after every request and every page of things built. event is a dict:
+			{"type":"request", "endpoint", "status", "wait" (seconds held by the rate limiter), "latency" (seconds on the network), "parse" (seconds decoding JSON), "bytes", "retries", "cached", "shared", "error"}
+		"shared" requests got the response of an identical one that was already in flight; they're also "cached".
+			{"type":"build", "endpoint", "items", "seconds"}
+		Hooks run in the thread that made the request, so they should be quick."""
+		self.hooks.append(f)
+
+	def remove_hook(self, f):
+		self.hooks.remove(f)
+
+	def enable_metrics(self):
+		"""Start collecting per-endpoint counts and timings in a RequestStats (also kept in self.metrics), and return it"""
+		if self.metrics is None:
+			self.metrics = RequestStats()
+			self.add_hook(self.metrics.record)
+		return self.metrics
+
+	def req(self, url_name, rname="", args={}, get_args=None, priority=None):
+		"""Build a request, send it through the dispatcher, and return the response body
+		priority is one of the ActionScheduler priorities. By default writes (posts) are URGENT and reads are NORMAL.
+		A session can be shared between threads. If several ask for the same GET (endpoint, rname and arguments) at once, one request is made and each of them gets its own decoded copy of the response."""
+		if not self.hooks:	#the common case costs one check
+			return self._req(url_name, rname, args, get_args, priority, None)
+		trace = {"type":"request", "endpoint":url_name, "status":None, "wait":0.0, "latency":0.0, "parse":0.0, "bytes":0, "retries":0, "cached":False, "shared":False, "error":None}
+		try:
+			return self._req(url_name, rname, args, get_args, priority, trace)
+		except Exception as e:
+			trace["error"] = type(e).__name__
+			raise
+		finally:
+			self._emit(trace)
+
+	def _emit(self, event):
+		for f in self.hooks:
+			f(event)
+
+	def _req(self, url_name, rname, args, get_args, priority, trace):
 		u = RedditSession.urls[url_name]
-		url = "https://%s.reddit.com/%s" % (u['host'] if u.get('host') else 'oauth', u['url'])
+		if self.oauth_reads and not u["auth"] and u["method"] == "get":
+			u = dict(u, auth=True, host=None)
+		if priority is None:
+			priority = ActionScheduler.URGENT if u['method'] == 'post' else ActionScheduler.NORMAL
+		url = self.url_base.replace("$h", u['host'] if u.get('host') else 'oauth') + u['url']
 		url = url.replace("$r", rname)
-		if u['method'] == 'get':
-			url += "?" + "&".join(["%s=%s" % (x[0], x[1]) for x in get_args.items()])
 		args = dict(u["args"], **args)	#later ones override in case of collision with defaults
+		if u['method'] == 'get':	#everything goes in the query string
+			url += "?" + urllib.parse.urlencode(dict(args, **(get_args or {})))
+			args = {}
+		ttl = u.get("cache") if self.cache is not None else None
+		key = (url_name, rname, urllib.parse.urlencode(sorted((get_args or {}).items())), self.user if u["auth"] else "")
+		if ttl:
+			body = self.cache.get(key)
+			if body is not None:
+				if trace is not None:
+					trace["cached"] = True
+				return self._decode(body, trace)	#decoded fresh every time, so callers can modify what they get
+		if u['method'] != 'get':
+			return self._decode(self._send(u, url, args, priority, trace, None, None), trace)
+		flight = (url, key[3])	#the whole query string, since some GETs (morechildren) pass their arguments in args
+		with self.inflight_lock:
+			call = self.inflight.get(flight)
+			leader = call is None
+			if leader:
+				call = self.inflight[flight] = concurrent.futures.Future()
+		if not leader:	#someone else is already asking for this. wait for their answer
+			if trace is not None:
+				trace["cached"] = trace["shared"] = True
+			return self._decode(call.result(), trace)	#like the cache, share the bytes and decode them for each caller, so callers can modify what they get
+		try:
+			body = self._send(u, url, args, priority, trace, key, ttl)
+		except BaseException as e:
+			call.set_exception(e)
+			raise
+		else:
+			call.set_result(body)
+			return self._decode(body, trace)
+		finally:
+			with self.inflight_lock:
+				del self.inflight[flight]
+
+	def _send(self, u, url, args, priority, trace, key, ttl):
+		"""The part of _req() that goes to reddit.com: authenticate, send, retry once with a new token on 401, cache. Return the response body (bytes)."""
 		headers = {}
 		if u["auth"]:
-			if self.tokens == {}:
+			headers["Authorization"] = "bearer %s" % self._bearer()
+		try:
+			y = self.req_raw(url, args, headers, method=u['method'], priority=priority, trace=trace)
+		except requests.HTTPError as e:
+			if not u["auth"] or e.response is None or e.response.status_code != 401:
+				raise
+			headers["Authorization"] = "bearer %s" % self._bearer(rejected=headers["Authorization"][7:])	#token was revoked or expired early. get a new one and try exactly once more
+			if trace is not None:
+				trace["retries"] += 1
+			y = self.req_raw(url, args, headers, method=u['method'], priority=priority, trace=trace)
+		if ttl:
+			self.cache.put(key, y.content, ttl)
+		return y.content
+
+	def _bearer(self, rejected=None):
+		"""Return an access token that won't expire soon, logging in first if there isn't one.
+		If rejected is set, reddit.com has refused that token, so get a new one unless another thread already has.
+		One thread logs in at a time; the others wait for its token instead of logging in too."""
+		with self.token_lock:
+			if rejected is not None and self.tokens.get("bearer") == rejected:
+				self._invalidate_token()
+			if not self._token_is_fresh():
 				self._login()
-			headers["Authorization"] = "bearer %s" % self.tokens['bearer']
-		return json.loads(self.req_raw(url, args, headers, method=u['method']).text)
+			return self.tokens["bearer"]
+
+	def _decode(self, body, trace):
+		"""Parse a response body straight from the bytes, without decoding to str first"""
+		if trace is None:
+			return _json_loads(body)
+		t = time.perf_counter()
+		a = _json_loads(body)
+		trace["parse"] += time.perf_counter() - t
+		trace["bytes"] += len(body)
+		return a
 
-	def req_raw(self, url, args={}, hs={}, auth=None, method='get'):
-		"""Dispatch an actual request to reddit.com and return the Response object"""
+	def req_raw(self, url, args={}, hs={}, auth=None, method='get', priority=None, trace=None):
+		"""Dispatch an actual request to reddit.com and return the Response object
+		If trace is a dict, add the time spent waiting and on the network, and any retries, to it (see add_hook())."""
 
-		headers = hs
+		headers = dict(hs)	#don't modify the caller's (or the default) dict
 		headers["User-Agent"] = self.user_agent	#FIXME ensure the RHS is in quotes, because some characters are not valid naked on the RHS of HTTP headers
 
-		delay = self.next_req_time - time.time()
-		if delay > 0:
-			#print("have to sleep for %f" % (delay))
-			time.sleep(delay)
-
-		#print("url=%s, args=%s, headers=%s, method=%s, auth=%s" % (url, args, headers, method, auth))
-		if method == 'get':
-			headers = dict(headers, **args)
-			y = requests.get(url, headers=headers)
-		else:
-			if auth:	#TODO necessary?
-				y = requests.post(url, data=args, headers=headers, auth=auth)
-			else:
-				y = requests.post(url, data=args, headers=headers)
+		ratelimited = 0
+		failures = 0	#only reads are retried after these. a write may have gone through before the connection broke
+		while True:
+			delay = self.ratelimiter.wait(priority)
+			if trace is not None:
+				trace["wait"] += delay
+				trace["retries"] += ratelimited + failures > 0
+				t = time.perf_counter()
 
-		self.next_req_time = time.time() + 1
+			#print("url=%s, args=%s, headers=%s, method=%s, auth=%s" % (url, args, headers, method, auth))
+			try:
+				if method == 'get':
+					y = self.http.get(url, headers=dict(headers, **args))
+				else:
+					if auth:	#TODO necessary?
+						y = self.http.post(url, data=args, headers=headers, auth=auth)
+					else:
+						y = self.http.post(url, data=args, headers=headers)
+			except (requests.ConnectionError, requests.Timeout):
+				if method != 'get' or failures >= self.retries:
+					raise
+				failures += 1
+				self._backoff(failures, trace)
+				continue
+
+			if trace is not None:
+				trace["latency"] += time.perf_counter() - t
+				trace["status"] = y.status_code
+			self.ratelimiter.update(y.headers, y.status_code)
+			if y.status_code == 429 and ratelimited < RedditSession._ratelimit_retries:	#the limiter has already pushed the next slot back past Retry-After
+				ratelimited += 1
+				continue
+			if y.status_code in RedditSession._transient_statuses and method == 'get' and failures < self.retries:
+				failures += 1
+				self._backoff(failures, trace)
+				continue
+			break
 		if y.status_code != 200:	#FIXME reddit.com still returns 200 when there was a higher-level error
 			y.raise_for_status()
 		return y
 
-	def get_comments(self, rname, start=None):
+	def _backoff(self, failures, trace):
+		"""Sleep before retrying a request that failed for the failures-th time"""
+		delay = min(RedditSession._retry_backoff * 2 ** (failures - 1), 60) * random.uniform(0.5, 1.5)	#jitter, so clients that failed together don't retry together
+		if trace is not None:
+			trace["wait"] += delay
+		time.sleep(delay)
+
+	def get_comments(self, rname, start=None, output="objects", resume=None):
 		"""Get recent comments from rname and return a list of Comment objects
-		If start is set, work forward from just after there to the front. Otherwise, get the last RedditSession._listing_limit."""
+		If start is set, work forward from just after there to the front. Otherwise, get the last RedditSession._listing_limit.
+		output can be "objects" (the default), "dicts" (each item's raw data dict), or a list of field names (a tuple of those fields for each item, None where missing).
+		If a page can't be fetched even after retrying, IncompleteFetchException is raised. Call again with the same arguments and resume=e.cursor to carry on from that page.
+		The other listing methods take output and resume too."""
 		if start:
-			return self._get_listing("comments", rname, start)
+			return self._get_listing("comments", rname, start, output=output, resume=resume)
 		else:
-			return self._get_listing_backwards("comments", rname)
+			return self._get_listing_backwards("comments", rname, output=output, resume=resume)
 
-	def get_submissions(self, rname, start=None):
+	def get_submissions(self, rname, start=None, output="objects", resume=None):
 		"""Get recent submissions from rname
 		If start is set, work forward from just after there to the front. Otherwise, get the last RedditSession._listing_limit."""
 		if start:
-			return self._get_listing("submissions", rname, start)
+			return self._get_listing("submissions", rname, start, output=output, resume=resume)
 		else:
-			return self._get_listing_backwards("submissions", rname)
+			return self._get_listing_backwards("submissions", rname, output=output, resume=resume)
 
-	def get_user_overview(self, uname, start=None, limit=0):
+	def get_user_overview(self, uname, start=None, limit=0, output="objects", resume=None):
 		"""Get recent comments and submissions by user
 		If start is set, work forward from just after there to the front. Otherwise, get the last RedditSession._listing_limit."""
+		a = self._collect(self._iter_user("overview", uname, start, limit, False, output, resume), resume)
+		return a if start else list(reversed(a))
+
+	def get_thread(self, id, limit=_listing_limit, max_requests=None, max_comments=None, workers=1, flat=False, resume=None):	#FIXME limit is working in this function as a batch limit, not a limit on listing size
+		"""Get a thread (submission and comments) by id (without the 't3_')
+		Hidden comments are fetched with morechildren, up to max_requests requests and until there are max_comments comments, if those are set.
+		With workers > 1, that many morechildren batches are fetched at once (all still paced by the session's rate limiter).
+		The ids of hidden comments that weren't fetched are left in the thread's missing list.
+		If flat is set, return a FlatThread instead of a RedditThread.
+		If a morechildren batch can't be fetched even after retrying, IncompleteFetchException is raised. Its cursor["thread"] is the thread so far; pass resume=e.cursor to carry on expanding it."""
+		if resume is None:
+			items = self.req("thread", id, get_args={"limit":limit, "api_type":"json"})
 		try:
-			if start:	return self._get_listing("overview", uname, start)
-			else:			return self._get_listing_backwards("overview", uname, limit=limit)
-		except urllib.error.HTTPError as e:
-			if e.code == 404:	raise NoSuchUserException()
-
-	def get_thread(self, id, limit=_listing_limit):	#FIXME limit is working in this function as a batch limit, not a limit on listing size
-		"""Get a thread (submission and comments) by id (without the 't3_')"""
-		items = self.req("thread", id, get_args={"limit":limit, "api_type":"json"})
-
-		submission = self._thing_factory(items[0]["data"]["children"][0])
-		comments = self._listing_to_comment_array(items[1]["data"]["children"])
-		self._get_more_comments(comments, first=True)
-
-		return RedditThread(self, submission, comments)
-
-	def get_submission(self, id, limit=_listing_limit):
-		"""Get a submission by id (without the 't3_')"""
-		items = self.req("thread", id, get_args={"limit":0, "api_type":"json"})
-
-		return self._thing_factory(items[0]["data"]["children"][0])
+			with self._archive_batch():
+				if resume is None:
+					submission = self._thing_factory(items[0]["data"]["children"][0])
+					builder = _ThreadBuilder(self, submission.name)
+					builder.add_listing(items[1]["data"]["children"])
+					missing = self._get_more_comments(builder, max_requests, max_comments, workers)
+				else:
+					submission, builder = resume["submission"], resume["builder"]
+					missing = self._get_more_comments(builder, max_requests, max_comments, workers, resume["queue"], resume["missing"])
+		except IncompleteFetchException as e:
+			unfetched = [c for b, things in e.cursor["queue"] if things is None for c in b] + [c for m in builder.mores for c in m.children]
+			e.cursor.update(submission=submission, builder=builder, thread=RedditThread(self, submission, builder.comments + [c for o in builder.orphans.values() for c in o], e.cursor["missing"] + unfetched))
+			raise
+
+		if flat:
+			return FlatThread(self, submission, builder.finish(), missing)
+		return RedditThread(self, submission, builder.finish(), missing, builder.index, builder.more_counts)
+
+	def get_thread_delta(self, thread, limit=_listing_limit, max_requests=None, workers=1):
+		"""Fetch what's new in thread (a RedditThread) since it was fetched, and merge it into the tree in place.
+		The thread is asked for sorted by new, so recent comments come on the first page. Only RedditMore stubs that are new, or whose count has grown since the last fetch, are expanded, and the thread's missing comments are asked for again. The cost follows new activity, not thread size.
+		Return (added, changed): the new RedditComments, and the ones already in the thread whose data (body, score, edited...) changed."""
+		items = self.req("thread", thread.submission.id, get_args={"limit":limit, "sort":"new", "api_type":"json"})
+
+		with self._archive_batch():
+			thread.submission.update(items[0]["data"]["children"][0])
+			builder = _ThreadBuilder(self, thread.submission.name, thread.comments, thread.get_index(), track=True, counts=thread.more_counts or {})
+			builder.add_listing(items[1]["data"]["children"])
+			retry = [c for c in dict.fromkeys(thread.missing) if "t1_" + c not in builder.index]
+			queue = [[retry[i:i+RedditSession._morechildren_limit], None] for i in range(0, len(retry), RedditSession._morechildren_limit)]
+			try:
+				missing = self._get_more_comments(builder, max_requests, None, workers, queue)
+			except IncompleteFetchException as e:	#keep what was merged. what wasn't is left in missing, which the next refresh asks for again
+				missing = e.cursor["missing"] + [c for b, things in e.cursor["queue"] for c in b] + [c for m in builder.take_mores() for c in m.children]
+			builder.finish()
+			if not missing:	#otherwise keep the old counts, so stubs that grew are expanded again next time
+				thread.more_counts = dict(thread.more_counts or {}, **builder.more_counts)
+		thread.missing = [c for c in dict.fromkeys(thread.missing + missing) if "t1_" + c not in builder.index]	#some that were missing may have turned up
+		return builder.added, builder.changed
+
+	def get_submission(self, id):
+		"""Get a submission by id (without the 't3_'). This doesn't log in; use get_things() to see moderator-only fields such as reports."""
+		return self._get_things(["t3_" + id], True, "info_public")[0]
+
+	def get_comment(self, id):
+		"""Get a comment by id (without the 't1_'). Its replies aren't fetched. This doesn't log in; use get_things() to see moderator-only fields such as reports."""
+		return self._get_things(["t1_" + id], True, "info_public")[0]
+
+	def get_things(self, fullnames, strict=False):
+		"""Get comments, submissions and subreddits by fullname, RedditSession._info_batch per request.
+		Return them in the same order as fullnames, with None in place of any that reddit.com didn't return (deleted beyond recovery, or never existed).
+		If strict is set, raise NoSuchThingException with the missing fullnames instead."""
+		return self._get_things(fullnames, strict, "info")
+
+	def _get_things(self, fullnames, strict, url):
+		fullnames = list(fullnames)
+		unique = list(dict.fromkeys(fullnames))
+		found = {}
+		for chunk in [unique[i:i+RedditSession._info_batch] for i in range(0, len(unique), RedditSession._info_batch)]:
+			items = self.req(url, get_args={"id":",".join(chunk)})
+			with self._archive_batch():
+				for item in items["data"]["children"]:
+					found[item["data"]["name"]] = self._thing_factory(item)
+		missing = [f for f in unique if f not in found]
+		if strict and missing:
+			raise NoSuchThingException(missing)
+		return [found.get(f) for f in fullnames]
+
+	def get_submissions_by_id(self, ids, strict=False):
+		"""get_things() for submission ids (without the 't3_')"""
+		return self.get_things(["t3_" + i for i in ids], strict)
+
+	def get_comments_by_id(self, ids, strict=False):
+		"""get_things() for comment ids (without the 't1_')"""
+		return self.get_things(["t1_" + i for i in ids], strict)
 
 	def get_user(self, name):
 		"""Creates a RedditUser object"""
 		return RedditUser(self, name)
 
-	def _listing_to_comment_array(self, a):#, depth=0):	#DEBUG depth
-		coms = []
-		for c in a:
-			t = self._thing_factory(c)
-			if t.__class__ == RedditMore:
-				print(t)
-			if t.__class__ == RedditComment:
-				if c["data"]["replies"] != "" and c["data"]["replies"] != None:
-					t.replies = self._listing_to_comment_array(c["data"]["replies"]["data"]["children"])#, depth+1)
-			coms.append(t)
-		return coms
-
-	def _get_more_comments(self, root, to_get=[], first=False):
-		"""Get ommitted comments recursively.
-		root is the array of top-level comments (which contain their own children).
-		This function modifies root in-place."""
-		#recurse through the comments and build a list (to_get) of the omitted ones
-		for c in root:
-			if c.__class__ == RedditMore:
-				to_get += c.children
-				root.remove(c)
-			elif c.__class__ == RedditComment:
-				self._get_more_comments(c.replies, to_get)
-		if first:
-			to_add = []
+	def _get_more_comments(self, builder, max_requests=None, max_comments=None, workers=1, queue=None, missing=None):
+		"""Fetch the comments hidden behind builder's RedditMore stubs, and the stubs those turn up, until there are none left or the budget runs out.
+		Return the ids of hidden comments that weren't fetched.
+		If a batch can't be fetched, raise IncompleteFetchException with the queue and missing to pass back in to carry on."""
+		missing = missing if missing is not None else []
+		made = 0
+		with contextlib.ExitStack() as stack:
+			executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lightreddit-more")) if workers > 1 else None
+			queue = queue if queue is not None else []	#[batch, things] pairs in tree order. things is None until the batch has been fetched
 			while True:
-				for t in to_add:	#get the leftovers. to_add is empty first time through.
-					if t.__class__ == RedditMore:
-						to_get += t.children
-						to_add.remove(t)
-				#fetch the comments in to_get
-				link_id = root[0].link_id
-				for chunk in [to_get[i:i+RedditSession._morechildren_limit] for i in range(0, len(to_get), RedditSession._morechildren_limit)]:
-					t = self.req("morechildren", "", args={"children": ",".join(chunk), "link_id": link_id})
-					for a in t["json"]["data"]["things"]:
-						if a["data"]["id"] == "_":
-							print("ERROR")
-						to_add.append(self._thing_factory(a))
-				self._add_more_comments(root, to_add, first=True)
-				to_get = []	#blank the list for the next iteration
-				if len(to_add) == 0:
+				if len(queue) == 0:
+					queue = [[b, None] for b in self._morechildren_batches(builder.take_mores(), builder.index, builder.counts)]
+				if len(queue) == 0:
 					break
+				if (max_requests is not None and made >= max_requests) or (max_comments is not None and len(builder.index) >= max_comments):
+					missing += [c for b, things in queue for c in b] + [c for m in builder.take_mores() for c in m.children]
+					break
+				n = workers if max_requests is None else min(workers, max_requests - made)
+				wave = [q for q in queue if q[1] is None][:n]
+				try:
+					if executor:
+						results = list(executor.map(lambda q: self._fetch_morechildren(builder.link_id, q[0]), wave))
+					else:
+						results = [self._fetch_morechildren(builder.link_id, q[0]) for q in wave]
+				except Exception as e:
+					if not ActionScheduler._retryable(e):
+						raise
+					raise IncompleteFetchException({"queue":queue, "missing":missing}) from e
+				made += len(wave)
+				for q, things in zip(wave, results):
+					if things is not None:
+						q[1] = things
+						continue
+					i = queue.index(q)
+					if len(q[0]) > 1:	#rejected. split it in place so its halves keep its position in the tree
+						queue[i:i+1] = [[q[0][:len(q[0])//2], None], [q[0][len(q[0])//2:], None]]
+					else:
+						missing += q[0]	#reddit.com won't give us this one at all
+						del queue[i]
+				while queue and queue[0][1] is not None:	#add in batch order, so the tree comes out the same however many workers there are
+					for a in queue.pop(0)[1]:
+						builder.add_raw(a)
+		return missing
+
+	@staticmethod
+	def _morechildren_batches(mores, index, counts=None):
+		"""Pack the ids hidden behind mores into morechildren batches, keeping each RedditMore's ids together where they fit
+		counts (parent fullname -> the count of the stub under it, from the last time the thread was fetched) are for refreshing a thread. A stub's count is every comment under it, deleted ones included.
+		If it has grown since, something new is hiding somewhere under the stub, so it's asked for whole. If it hasn't, it's skipped: whatever the tree doesn't have under it is deleted, or already in the thread's missing."""
+		batches = []
+		cur = []
+		for m in mores:
+			if counts is not None and m.parent_id in counts:
+				ids = list(m.children) if (m.count or 0) > counts[m.parent_id] else []
+			else:
+				ids = [c for c in m.children if "t1_" + c not in index]
+			if len(cur) + len(ids) > RedditSession._morechildren_limit:
+				batches.append(cur)
+				cur = []
+			while len(ids) > RedditSession._morechildren_limit:
+				batches.append(ids[:RedditSession._morechildren_limit])
+				ids = ids[RedditSession._morechildren_limit:]
+			cur += ids
+		batches.append(cur)
+		return [b for b in batches if len(b) > 0]
+
+	def _fetch_morechildren(self, link_id, chunk):
+		"""Return the things for one batch of hidden children, or None if reddit.com rejected the batch"""
+		try:
+			t = self.req("morechildren", "", args={"children": ",".join(chunk), "link_id": link_id})
+		except requests.HTTPError as e:
+			if e.response is not None and e.response.status_code in (400, 413, 414, 500):	#reddit.com answers too-big batches with any of these
+				return None
+			raise
+		if t["json"].get("errors"):
+			return None
+		return t["json"]["data"]["things"]
+
+	def get_modlog(self, rname, start=None, output="objects", type=None, mod=None, since=None, resume=None):
+		"""Get the moderation log for a given subreddit, oldest first
+		If start (a modaction id) is set, get the actions after it. Paging stops as soon as it reaches start, so polling with the newest id seen costs one request when there's little new.
+		If since (a unix time) is set, stop at actions older than that. Otherwise, get the last RedditSession._listing_limit.
+		Modaction ids can't be compared, only matched, so when polling pass start's created_utc as since too. Then paging also stops if start has aged out of the log.
+		type (e.g. "removecomment") and mod filter the log on reddit.com's side."""
+		a = self._collect(self._iter_listing_backwards("modlog", rname, start or "", 0, False, output, since, self._modlog_params(type, mod), resume), resume)
+		return list(reversed(a))
 
-	def _add_more_comments(self, root, to_add, first=False):
-		"""Add newly-fetched comments to a tree"""
-		if first:
-			#first handle top-level comments. they have parent_id == thread's t3id
-			for t in to_add:
-				if t.__class__ == RedditComment:
-					if t.parent_id == t.link_id:
-						root.append(t)
-						to_add.remove(t)
-				self._add_more_comments(root, to_add)
-		#now handle all the other comments we fetched
-		for c in root:
-			for t in to_add:
-				if t.__class__ == RedditComment:
-					if t.parent_id == c.name:
-						c.replies.append(t)
-						to_add.remove(t)
-			self._add_more_comments(c.replies, to_add)
-
-	def get_modlog(self, rname, start=None):
-		"""Get the moderation log for a given subreddit
-		If start is set, work forward from there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		if start:	return self._get_listing("modlog", rname, start)
-		else:			return self._get_listing_backwards("modlog", rname)
-
-	def get_inbox(self, start=None):
+	def get_inbox(self, start=None, output="objects", resume=None):
 		"""Get messages from inbox
 		If start is set, work forward from there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		if start:	return self._get_listing("inbox", "", start)
-		else:			return self._get_listing_backwards("inbox")
+		if start:	return self._get_listing("inbox", "", start, output=output, resume=resume)
+		else:			return self._get_listing_backwards("inbox", output=output, resume=resume)
 
-	def get_sent(self, start=None):
+	def get_sent(self, start=None, output="objects", resume=None):
 		"""Get sent messages
 		If start is set, work forward from there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		if start:	return self._get_listing("sent", "", start)
-		else:			return self._get_listing_backwards("sent")
+		if start:	return self._get_listing("sent", "", start, output=output, resume=resume)
+		else:			return self._get_listing_backwards("sent", output=output, resume=resume)
 
 	def message(self, user, subject, text):
 		"""Send a private message to user (or modmail, if user is #subredditname)."""
-		self.session.req("compose", args={"to":user, "subject":subject, "text":text})
+		self.req("compose", args={"to":user, "subject":subject, "text":text})
 
-	def get_user_comments(self, uname="", start=None, limit=0):
+	def get_user_comments(self, uname="", start=None, limit=0, output="objects", resume=None):
 		"""Get comments by a user
 		If start is set, work forward from there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		if not uname:
-			if not self.user:
-				raise RuntimeError("no username or password set")
-			uname = self.user
-		try:
-			if start:	return self._get_listing("u_comments", uname, start)
-			else:			return self._get_listing_backwards("u_comments", uname, limit=limit)
-		except urllib.error.HTTPError as e:
-			if e.code == 404:	raise NoSuchUserException()
+		a = self._collect(self._iter_user("u_comments", uname, start, limit, False, output, resume), resume)
+		return a if start else list(reversed(a))
 
-	def get_user_submitted(self, uname="", start=None, limit=0):
+	def get_user_submitted(self, uname="", start=None, limit=0, output="objects", resume=None):
 		"""Get submissions by a user
 		If start is set, work forward from there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		if not uname:
-			if not self.user:
-				raise RuntimeError("no username or password set")
-			uname = self.user
+		a = self._collect(self._iter_user("u_submitted", uname, start, limit, False, output, resume), resume)
+		return a if start else list(reversed(a))
+
+	def get_user_histories(self, names, kinds=("overview",), limit=0, workers=4, max_age=_history_ttl):
+		"""Get the histories of many users at once, up to workers lookups at a time (all paced by the session's rate limiter).
+		kinds can include "overview", "comments" and "submitted". Return {name: {kind: [things, oldest first]}}, with a NoSuchUserException in place of the dict for users that don't exist (or are shadowbanned).
+		Histories are remembered, and reused for max_age seconds. After that, only what's newer than the last item fetched is asked for and added on."""
+		names = list(dict.fromkeys(names))
+		jobs = [(n, k) for n in names for k in kinds]
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="lightreddit-users") as executor:
+			results = list(executor.map(lambda job: self._user_history(job[0], job[1], limit, max_age), jobs))
+		a = {}
+		for (n, k), r in zip(jobs, results):
+			if isinstance(r, NoSuchUserException):
+				a[n] = r
+			elif not isinstance(a.get(n), NoSuchUserException):
+				a.setdefault(n, {})[k] = r
+		return a
+
+	def _user_history(self, uname, kind, limit, max_age):
+		"""One user's history of one kind, from self.histories while it's fresh. Return a NoSuchUserException instead of raising it."""
+		key = (uname.lower(), kind, limit)
+		with self.histories_lock:
+			e = self.histories.get(key)
+		now = time.time()
+		if e is not None and now - e[0] < max_age:
+			return e[1] if isinstance(e[1], NoSuchUserException) else list(e[1])
+		if e is not None and isinstance(e[1], NoSuchUserException):
+			e = None
+		get = {"overview":self.get_user_overview, "comments":self.get_user_comments, "submitted":self.get_user_submitted}[kind]
 		try:
-			if start:	return self._get_listing("u_submitted", uname, start)
-			else:			return self._get_listing_backwards("u_submitted", uname, limit=limit)
-		except urllib.error.HTTPError as e:
-			if e.code == 404:	raise NoSuchUserException()
+			if e is not None and e[1]:
+				items = e[1] + get(uname, start=e[1][-1].name)	#just what's new since last time
+				if limit:
+					items = items[-limit:]
+			else:
+				items = get(uname, limit=limit)
+		except NoSuchUserException as ex:
+			items = ex	#remembered too, so missing users aren't looked up again on every call
+		with self.histories_lock:
+			self.histories[key] = (now, items)
+			self.histories.move_to_end(key)
+			while len(self.histories) > RedditSession._history_cache_size:
+				self.histories.popitem(last=False)
+		return items if isinstance(items, NoSuchUserException) else list(items)
 
 	def get_flairlist(self, rname):
 		"""Get a subreddit's flairlist"""
-		a = []
-		n = ""
-		done = False
-		while True:
-			items = self.req("flairlist", rname, get_args={"after":n, "limit":1000})
-			try:
-				n = items["next"]
-			except KeyError:
-				done = True
-			a.extend(items["users"])
-			if done:
-				break
-		return a
+		return list(self.iter_flairlist(rname))
+
+	def iter_flairlist(self, rname, prefetch=False):
+		"""Like get_flairlist(), but yield each user's flair dict ({"user", "flair_text", "flair_css_class"}) as its page arrives, so the whole list never has to be in memory.
+		With prefetch, the next page is fetched in the background while the current one is consumed."""
+		with self._prefetcher(prefetch) as executor:
+			fetch = self._page_fetcher("flairlist", rname, executor)
+			pending = fetch({"after":"", "limit":RedditSession._flairlist_batch})
+			while pending:
+				items = pending.result()
+				pending = None
+				if items.get("next"):
+					pending = fetch({"after":items["next"], "limit":RedditSession._flairlist_batch})
+				yield from items["users"]
+
+	@staticmethod
+	def flair_diff(current, desired, remove_missing=False):
+		"""Compare current flair (flair dicts, e.g. from iter_flairlist()) with desired ({user: (text, css_class)}, {user: text}, or None to remove a user's flair).
+		Return the (user, text, css_class) rows that set_flair_bulk() needs to make current match desired. Users who aren't in desired are left alone, unless remove_missing is set.
+		current is only read once, so it can be a live iter_flairlist()."""
+		want = {}
+		for user, f in desired.items():
+			if f is None:
+				f = ("", "")
+			elif isinstance(f, str):
+				f = (f, "")
+			want[user.lower()] = (user, f[0] or "", f[1] or "")
+		rows = []
+		seen = set()
+		for f in current:
+			user = f["user"].lower()
+			have = (f.get("flair_text") or "", f.get("flair_css_class") or "")
+			seen.add(user)
+			if user in want:
+				if want[user][1:] != have:
+					rows.append(want[user])
+			elif remove_missing and have != ("", ""):
+				rows.append((f["user"], "", ""))
+		rows += [w for user, w in want.items() if user not in seen and w[1:] != ("", "")]	#no flair yet
+		return rows
+
+	def set_flair_bulk(self, rname, rows):
+		"""Set many users' flair with api/flaircsv, RedditSession._flaircsv_batch users per request. rows are (user, text, css_class); empty text and css_class remove a user's flair.
+		Return reddit.com's result for each row ({"ok", "status", "errors", "warnings"}), in order."""
+		rows = list(rows)
+		results = []
+		for i in range(0, len(rows), RedditSession._flaircsv_batch):
+			f = io.StringIO()
+			csv.writer(f, lineterminator="\n").writerows(rows[i:i+RedditSession._flaircsv_batch])
+			results += self.req("flaircsv", rname, args={"flair_csv":f.getvalue()})
+		return results
+
+	def update_flair(self, rname, desired, remove_missing=False):
+		"""Make rname's flair match desired (see flair_diff()), streaming the current flairlist and only sending the changes. Return set_flair_bulk()'s results."""
+		return self.set_flair_bulk(rname, self.flair_diff(self.iter_flairlist(rname, prefetch=True), desired, remove_missing))
 
 	def get_modmail(self, rname, start=None, limit=0):
 		"""Get modmail for a subreddit
@@ -366,7 +780,10 @@ class RedditSession():
 				s[k] = ""
 		#if len(keys) != len(s.keys()):
 		#	raise BadSettingsException("Wrong number of arguments provided")
-		return self.req("site_admin", args=s)
+		response = self.req("site_admin", args=s)
+		self._invalidate("edit", rname)
+		self._invalidate("about", rname)
+		return response
 
 	def get_banned(self, rname, start=None):
 		"""Get banned users for a subreddit"""
@@ -378,61 +795,217 @@ class RedditSession():
 			a.append(RedditBan(self, b))
 		return a
 
-	def _get_listing(self, url, rname, start, sort=None):
+	def iter_comments(self, rname, start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_comments(), but yield comments as each page arrives instead of waiting for all of them.
+		If start is set, yield oldest first from just after start. Otherwise, yield newest first.
+		Pages are only fetched as they're needed. With prefetch, the next page is fetched in the background while the current one is consumed."""
+		return self._iter("comments", rname, start, limit, prefetch, output)
+
+	def iter_submissions(self, rname, start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_submissions(), but yield submissions as each page arrives. See iter_comments()."""
+		return self._iter("submissions", rname, start, limit, prefetch, output)
+
+	def iter_modlog(self, rname, start=None, limit=0, prefetch=False, output="objects", type=None, mod=None, since=None):
+		"""Like get_modlog(), but yield actions newest first as each page arrives. If start or since is set, they're yielded oldest first once they've all arrived instead."""
+		items = self._iter_listing_backwards("modlog", rname, start or "", limit, prefetch, output, since, self._modlog_params(type, mod))
+		if start or since:
+			return reversed(list(items))
+		return items
+
+	@staticmethod
+	def _modlog_params(type, mod):
+		return {k: v for k, v in (("type", type), ("mod", mod)) if v}
+
+	def iter_inbox(self, start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_inbox(), but yield messages as each page arrives. See iter_comments()."""
+		return self._iter("inbox", "", start, limit, prefetch, output)
+
+	def iter_sent(self, start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_sent(), but yield messages as each page arrives. See iter_comments()."""
+		return self._iter("sent", "", start, limit, prefetch, output)
+
+	def iter_user_overview(self, uname, start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_user_overview(), but yield items as each page arrives. See iter_comments()."""
+		return self._iter_user("overview", uname, start, limit, prefetch, output)
+
+	def iter_user_comments(self, uname="", start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_user_comments(), but yield comments as each page arrives. See iter_comments()."""
+		return self._iter_user("u_comments", uname, start, limit, prefetch, output)
+
+	def iter_user_submitted(self, uname="", start=None, limit=0, prefetch=False, output="objects"):
+		"""Like get_user_submitted(), but yield submissions as each page arrives. See iter_comments()."""
+		return self._iter_user("u_submitted", uname, start, limit, prefetch, output)
+
+	def _iter(self, url, rname, start, limit, prefetch, output, resume=None):
+		if start:	return self._iter_listing(url, rname, start, prefetch=prefetch, output=output, resume=resume, limit=limit)
+		else:			return self._iter_listing_backwards(url, rname, limit=limit, prefetch=prefetch, output=output, resume=resume)
+
+	def _iter_user(self, url, uname, start, limit, prefetch, output, resume=None):
+		"""_iter() for listings under user/, which 404 for users that don't exist (or are shadowbanned)"""
+		if not uname:
+			if not self.user:
+				raise RuntimeError("no username or password set")
+			uname = self.user
+		try:
+			yield from self._iter(url, uname, start, limit, prefetch, output, resume)
+		except requests.HTTPError as e:
+			if e.response is not None and e.response.status_code == 404:
+				raise NoSuchUserException(uname)
+			raise
+
+	def _build(self, url, items, make):
+		"""make() each item, archiving the page first if there's an archive. With hooks, do a whole page at once and report how long it took."""
+		if self.archive is not None:
+			items = list(items)
+			self.archive.put(items)
+		if not self.hooks:
+			return map(make, items)
+		t = time.perf_counter()
+		a = [make(x) for x in items]
+		self._emit({"type":"build", "endpoint":url, "items":len(a), "seconds":time.perf_counter() - t})
+		return a
+
+	def _output(self, output):
+		"""Return the function that turns a listing item into what the caller asked for. See get_comments()."""
+		if output == "objects":
+			return self._make_thing	#_build() has already archived the page
+		if output == "dicts":
+			return lambda x: x["data"]
+		if isinstance(output, str):		#a single field name would be taken apart into characters
+			raise ValueError("output must be \"objects\", \"dicts\" or a sequence of field names, not %r" % output)
+		fields = tuple(output)
+		return lambda x: tuple(x["data"].get(k) for k in fields)
+
+	def _page_fetcher(self, url, rname, executor):
+		"""Return a function that starts fetching a page of a listing and returns a Future-like object for it.
+		Without an executor, nothing is fetched until result() is called."""
+		if executor:
+			return lambda get_args: executor.submit(self.req, url, rname, get_args=get_args)
+		return lambda get_args: _Deferred(self.req, url, rname, get_args=get_args)
+
+	@contextlib.contextmanager
+	def _prefetcher(self, prefetch):
+		"""A single background thread for fetching the next page of a listing, or None if prefetch is off"""
+		if not prefetch:
+			yield None
+			return
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="lightreddit-prefetch")
+		try:
+			yield executor
+		finally:
+			executor.shutdown(wait=False, cancel_futures=True)	#the consumer may have stopped early. don't make it wait for a page it won't read
+
+	def _collect(self, items, resume=None):
+		"""list(items), after the items already collected in resume if it's set.
+		If fetching fails for good, add everything collected so far to the IncompleteFetchException's cursor, so the caller can see it and resume with it."""
+		a = list(resume["items"]) if resume else []
+		try:
+			for x in items:
+				a.append(x)
+		except IncompleteFetchException as e:
+			e.cursor["items"] = a
+			raise
+		return a
+
+	@staticmethod
+	def _page(pending, cursor):
+		"""pending.result(), turning a failure that retrying might fix into IncompleteFetchException(cursor)"""
+		try:
+			return pending.result()
+		except Exception as e:
+			if not ActionScheduler._retryable(e):
+				raise
+			raise IncompleteFetchException(cursor) from e
+
+	def _get_listing(self, url, rname, start, sort=None, output="objects", resume=None):
 		"""Get recent items from a listing
 		If start is set, work forward from just after there to the front. Otherwise, get the last RedditSession._listing_limit."""
-		a = []
-		n = start if start is not None else ""		#requesting "before=t3_" has the effect of not even including the request parameter
-		while True:
-			items = self.req(url, rname, get_args={"limit":RedditSession._listing_batch,"before":n})
-			if len(items["data"]["children"]) == 0:	#maybe there's nothing to get, or maybe our 'before=' thing disappeared from reddit and we're missing data
-				#print("DEBUG: switching to backwards mode with end==%s" % (start))
-				return self._get_listing_backwards(url, rname, start) #to be safe, we'll start grabbing things from the front working backwards until we overlap the tid of what we thought was the latest
-			for item in reversed(items["data"]["children"]):
-				a.append(self._thing_factory(item))
-			if start and len(items["data"]["children"]) == RedditSession._listing_batch:	#maybe there were more than RedditSession._listing_batch items, so try to get more
-				n = a[-1].name
-			else:
-				break
-			if len(a) > min(RedditSession._listing_limit, 2000):	#safety stop at 2000
-				break
-
+		a = self._collect(self._iter_listing(url, rname, start, output=output, resume=resume), resume)
 		if sort:
 			return sorted(a, key=lambda x: getattr(x, sort))
 		return a
 
-	def _get_listing_backwards(self, url, rname="", end="", sort=None, limit=0):
+	def _iter_listing(self, url, rname, start, prefetch=False, output="objects", resume=None, limit=0):
+		"""Yield recent items from a listing, oldest first, as each page arrives. See _get_listing().
+		If limit is set, stop after the limit items just after start."""
+		make = self._output(output)
+		n = start if start is not None else ""		#requesting "before=t3_" has the effect of not even including the request parameter
+		count = 0
+		if resume:
+			n, count = resume["before"], resume["count"]
+		batch = min(RedditSession._listing_batch, limit) if limit > 0 else RedditSession._listing_batch
+		with self._prefetcher(prefetch) as executor:
+			fetch = self._page_fetcher(url, rname, executor)
+			pending = fetch({"limit":batch,"before":n})
+			while pending:
+				children = self._page(pending, {"listing":url, "rname":rname, "before":n, "count":count})["data"]["children"]
+				if limit > 0:
+					children = children[max(len(children) - (limit - count), 0):]	#pages are newest first, so the ones nearest start are at the end
+				if len(children) == 0:
+					if count == 0:	#maybe there's nothing to get, or maybe our 'before=' thing disappeared from reddit and we're missing data
+						#print("DEBUG: switching to backwards mode with end==%s" % (start))
+						try:
+							fallback = self._get_listing_backwards(url, rname, start, output=output) #to be safe, we'll start grabbing things from the front working backwards until we overlap the tid of what we thought was the latest
+						except IncompleteFetchException as e:
+							raise IncompleteFetchException({"listing":url, "rname":rname, "before":n, "count":0}) from e.__cause__	#resuming starts the fallback over
+						yield from (fallback[:limit] if limit > 0 else fallback)
+					return
+				count += len(children)
+				pending = None
+				if start and len(children) == batch and count <= min(RedditSession._listing_limit, 2000) and (limit == 0 or count < limit):	#maybe there were more than batch items, so try to get more. safety stop at 2000
+					n = children[0]["data"].get("name") or children[0]["data"]["id"]	#newest in this batch. modlog entries only have an id
+					pending = fetch({"limit":batch,"before":n})
+				yield from self._build(url, reversed(children), make)
+
+	def _get_listing_backwards(self, url, rname="", end="", sort=None, limit=0, output="objects", resume=None):
 		"""Get recent items to a listing
 		If start is set, work backward from front to there. Otherwise, get the last RedditSession._listing_limit."""
-		try:
-			end_int = int(end[3:], 36) if end != "" else 0
-		except ValueError:
-			end_int = 0	#something that doesn't have an id36, like Modlog. In that case, always fetch to the max limit
-		a = []
-		n = ""		#start from the most recent every time
-		batch = min(RedditSession._listing_batch, limit) if limit > 0 else RedditSession._listing_batch
-		while True:
-			items = self.req(url, rname, get_args={"limit":batch,"after":n})	#get RedditSession._listing_batch every time and manually find the stopping point later
-			passed_end = False
-			for item in items["data"]["children"]:
-				try:
-					if int(item["data"]["id"], 36) > end_int:	#haven't reach the end yet
-						a.append(self._thing_factory(item))
-					else:
-						passed_end = True				#note that we can't break early because reddit might not return the results in tid order. maybe. let's be safe and process the whole batch.
-				except ValueError:
-					a.append(self._thing_factory(item))	#something that can't be compared, like Modlog. In that case, always fetch to the max limit
-			if len(items["data"]["children"]) == 0 or passed_end:
-				break
-			if len(a) > min(RedditSession._listing_limit, 2000) or (limit != 0 and len(a) >= limit):	#safety stop at 2000
-				break
-			n = items["data"]["after"]
-			if n == None:
-				break
+		a = self._collect(self._iter_listing_backwards(url, rname, end, limit, output=output, resume=resume), resume)
 		if sort:
 			return sorted(a, key=lambda x: getattr(x, sort))
 		return list(reversed(a))
 
+	def _iter_listing_backwards(self, url, rname="", end="", limit=0, prefetch=False, output="objects", since=None, params=None, resume=None):
+		"""Yield recent items from a listing, newest first, as each page arrives. See _get_listing_backwards().
+		If since is set, also stop at items created before then. params are added to every page request."""
+		make = self._output(output)
+		end_int = int(end[3:], 36) if end[:1] == "t" and end[2:3] == "_" else 0	#a fullname. anything else (a modaction id) is matched exactly instead
+		count = 0
+		n = ""	#start from the most recent every time
+		if resume:
+			n, count = resume["after"], resume["count"]
+		batch = min(RedditSession._listing_batch, limit) if limit > 0 else RedditSession._listing_batch
+		with self._prefetcher(prefetch) as executor:
+			fetch = self._page_fetcher(url, rname, executor)
+			pending = fetch(dict(params or {}, limit=batch, after=n))
+			while pending:
+				items = self._page(pending, {"listing":url, "rname":rname, "after":n, "count":count})	#get RedditSession._listing_batch every time and manually find the stopping point later
+				a = []
+				passed_end = False
+				for item in items["data"]["children"]:
+					data = item["data"]
+					if since is not None and data.get("created_utc", since) < since:
+						passed_end = True
+						continue
+					if item["kind"] == "modaction":	#ids are uuids, not id36s. the cursor is end itself, and since (its created_utc) in case it has expired from the log
+						if passed_end or (end != "" and (data.get("name") or data["id"]) == end):
+							passed_end = True	#everything after end in the log is older
+						else:
+							a.append(item)
+					elif int(data["id"], 36) > end_int:	#haven't reach the end yet
+						a.append(item)
+					else:
+						passed_end = True				#note that we can't break early because reddit might not return the results in tid order. maybe. let's be safe and process the whole batch.
+				if limit != 0:
+					a = a[:limit - count]
+				count += len(a)
+				pending = None
+				n = items["data"]["after"]
+				if not (len(items["data"]["children"]) == 0 or passed_end or n == None):
+					if not (count > min(RedditSession._listing_limit, 2000) or (limit != 0 and count >= limit)):	#safety stop at 2000
+						pending = fetch(dict(params or {}, limit=batch, after=n))
+				yield from self._build(url, a, make)
+
 	def submit(self, rname, title, text, distinguish=False, sendreplies=False):
 		"""Submit a new post to rname"""
 		args={"sr":rname, "kind":"self", "title":title, "text":text}
@@ -449,25 +1022,99 @@ class RedditSession():
 			new_thing.distinguish()
 		return new_thing
 
-	def ban(self, rname, user, note):
-		"""Ban user from rname with reason note"""
-		self.req("ban", args={"r":rname, "name":user, "note":note})
+	def ban(self, rname, user, note, queued=False):
+		"""Ban user from rname with reason note. If queued, send it through self.actions and return a Future instead of waiting."""
+		return self._write("ban", args={"r":rname, "name":user, "note":note}, key="%s/%s" % (rname, user), queued=queued)
 
-	def unban(self, rname, user):
-		"""Unban user from rname"""
-		self.req("unban", args={"r":rname, "name":user})
+	def unban(self, rname, user, queued=False):
+		"""Unban user from rname. If queued, send it through self.actions and return a Future instead of waiting."""
+		return self._write("unban", args={"r":rname, "name":user}, key="%s/%s" % (rname, user), queued=queued)
+
+	def _write(self, url_name, rname="", args={}, key=None, queued=False, parse=None):
+		"""Send a write and return parse(response) (or the response), or if queued, put it on self.actions and return its Future"""
+		if queued:
+			return self.actions.submit(url_name, rname, args, key=key, parse=parse)
+		response = self.req(url_name, rname, args)
+		return parse(response) if parse else response
 
 	def wiki_write(self, rname, page, content, reason=""):
 		"""Write content (in reddit markdown) to rname's wiki page with optional reason. All exsting content is overwritten."""
 		self.req("wiki_write", rname, args={"page":page, "content":content, "reason":reason})
+		self._invalidate("wiki", "%s/wiki/%s" % (rname, page))
 
 	def wiki_get(self, rname, page):
 		"""Return wiki page."""
-		a = self.req_raw("https://api.reddit.com/r/%s/wiki/%s.json" % (rname, page)).read().decode("utf8")
-		return RedditWikipage(self, json.loads(a))
+		return RedditWikipage(self, self.req("wiki", "%s/wiki/%s" % (rname, page)))
+
+	def _invalidate(self, url_name, rname):
+		"""Drop a cached response that a write has made stale"""
+		if self.cache is not None:
+			self.cache.invalidate(url_name, rname)
+
+	def sync_comments(self, rname):
+		"""Archive rname's comments that are newer than the last sync (or, the first time, the last RedditSession._listing_limit). Return how many were fetched."""
+		return self._sync(self.iter_comments, "comments", rname)
+
+	def sync_submissions(self, rname):
+		"""Archive rname's submissions that are newer than the last sync. See sync_comments()."""
+		return self._sync(self.iter_submissions, "submissions", rname)
+
+	def sync_modlog(self, rname):
+		"""Archive rname's moderation log entries that are newer than the last sync. See sync_comments()."""
+		return self._sync(self.iter_modlog, "modlog", rname, by_time=True)
+
+	def sync_user(self, uname):
+		"""Archive uname's comments and submissions that are newer than the last sync. See sync_comments()."""
+		return self._sync(self.iter_user_overview, "overview", uname)
+
+	def _sync(self, iterate, url, rname, by_time=False):
+		"""Page through a listing from the archive's high-water mark for it, then move the mark to the newest item seen
+		If by_time is set, also stop at items older than the mark, for listings whose ids can only be matched (see get_modlog())."""
+		if self.archive is None:
+			raise RuntimeError("this session has no archive")
+		listing = "%s:%s" % (url, rname.lower())
+		mark = self.archive.get_mark(listing)
+		kwargs = {}
+		last = self.archive.get(mark) if by_time and mark is not None else None
+		if last is not None:
+			kwargs["since"] = last["data"]["created_utc"]
+		newest = None
+		count = 0
+		for d in iterate(rname, mark, output="dicts", **kwargs):	#_build() archives each page as it arrives
+			count += 1
+			if newest is None or d["created_utc"] >= newest["created_utc"]:
+				newest = d
+		if newest is not None:
+			self.archive.set_mark(listing, newest.get("name") or newest["id"])	#modlog entries only have an id
+		return count
+
+	def get_archived(self, kind=None, subreddit=None, author=None, since=None, until=None, limit=None, output="objects"):
+		"""Return archived things, newest first, without any requests. See ThingArchive.query() for the filters and get_comments() for output.
+		e.g. a user's comments in a subreddit over the last 30 days: get_archived("t1", "python", "someone", since=time.time() - 30*86400)"""
+		if self.archive is None:
+			raise RuntimeError("this session has no archive")
+		make = self._output(output)
+		return [make(x) for x in self.archive.query(kind, subreddit, author, since, until, limit)]
+
+	def _archive_batch(self):
+		"""Group the things built in a with block into one archive transaction"""
+		if self.archive is None:
+			return contextlib.nullcontext()
+		return self.archive.batch()
 
 	def _thing_factory(self, x):
-		"""Create the proper object for a thing"""
+		"""Create the proper object for a thing, and archive it if there's an archive"""
+		if self.archive is not None:
+			self.archive.put((x,))
+		return self._make_thing(x)
+
+	def _make_thing(self, x):
+		t = self._new_thing(x)
+		if not self.keep_raw and t is not None:
+			t.drop_raw()
+		return t
+
+	def _new_thing(self, x):
 		if x["kind"] == "t1":
 			return RedditComment(self, x)
 		if x["kind"] == "t3":
@@ -485,8 +1132,54 @@ class RedditSession():
 		else:
 			print("DEBUG: unknown thing type: %s" % (x))
 
-class RedditThing:
-	"""A comment or submission. Could also be a message in the future, but that's unused now."""
+class _Field():
+	"""One of a RedditThing's fields (or user_fields). It's decoded from the thing's raw data the first time it's read, then kept in a slot."""
+
+	__slots__ = ("key", "slot", "user")
+
+	def __init__(self, key, slot, user):
+		self.key = key
+		self.slot = slot	#the member descriptor of the __slots__ entry that holds the decoded value
+		self.user = user	#wrap the value in a RedditUser
+
+	def __get__(self, obj, cls=None):
+		if obj is None:
+			return self
+		try:
+			return self.slot.__get__(obj, cls)
+		except AttributeError:	#not decoded yet
+			pass
+		if obj.raw is None or self.key not in obj.raw["data"]:
+			raise AttributeError(self.key)	#If reddit.com didn't send us a key, then we're not supposed to have it.
+		v = obj.raw["data"][self.key]
+		if self.user:
+			v = RedditUser(obj.session, v)
+		self.slot.__set__(obj, v)
+		return v
+
+	def __set__(self, obj, value):
+		self.slot.__set__(obj, value)
+
+	def __delete__(self, obj):
+		self.slot.__delete__(obj)
+
+class _ThingType(type):
+	"""Metaclass for RedditThings. Gives each class a __slots__ entry and a lazy _Field for each of its fields and user_fields, so things don't need a __dict__."""
+
+	def __new__(mcs, name, bases, ns):
+		keys = [(k, False) for k in ns.get("fields", [])] + [(k, True) for k in ns.get("user_fields", [])]
+		keys = [(k, user) for k, user in keys if not any(isinstance(getattr(b, k, None), _Field) for b in bases)]
+		ns["__slots__"] = tuple(ns.get("__slots__", ())) + tuple("_" + k for k, user in keys)
+		cls = super().__new__(mcs, name, bases, ns)
+		for k, user in keys:
+			setattr(cls, k, _Field(k, cls.__dict__["_" + k], user))
+		return cls
+
+class RedditThing(metaclass=_ThingType):
+	"""A comment or submission. Could also be a message in the future, but that's unused now.
+	Fields are decoded from raw the first time they're used. Call drop_raw() to decode them all and free raw."""
+
+	__slots__ = ("session", "kind", "raw")
 
 	def __init__(self, session, data):
 		#print("handling a %s" % (self.__class__))
@@ -494,47 +1187,65 @@ class RedditThing:
 			raise NotImplementedError("This is an abstract class.")
 		self.session = session
 		self.kind = data["kind"]
-		for k in type(self).fields:
-			try:
-				setattr(self, k, data["data"][k])
-			except KeyError:
-				pass #we don't care. If reddit.com didn't send us a key, then we're not supposed to have it.
-		try:
-			for k in type(self).user_fields:
-				try:
-					setattr(self, k, RedditUser(session, data["data"][k]))
-				except KeyError:
-					pass
-		except AttributeError:
-			pass
 		#self.int_id = int(self.id,36)
 		self.raw = data
 
-	def reply(self, text, distinguish=False):
-		"""Reply to the thing"""
-		response = self.session.req("reply", args={"thing_id":self.name, "text":text})
-		new_thing = RedditComment(self.session, response["json"]["data"]["things"][0])
-		if new_thing == None:	#the response didn't tell us what the new thing is, so it probably didn't submit successfully
-			raise RuntimeError #FIXME make the error more specific
-		if distinguish:
-			new_thing.distinguish()
-
-	def distinguish(self, distinguish=True):
+	def drop_raw(self):
+		"""Decode every field and free the raw JSON this thing was built from"""
+		if self.raw is None:
+			return
+		for k in getattr(type(self), "fields", []) + getattr(type(self), "user_fields", []):
+			getattr(self, k, None)
+		self.raw = None
+
+	def update(self, data):
+		"""Replace this thing's data with a newer copy of it (raw JSON, as from a listing) in place. Return True if any field's value changed."""
+		keys = getattr(type(self), "fields", []) + getattr(type(self), "user_fields", [])
+		new = data["data"]
+		changed = False
+		for k in keys:
+			old = getattr(self, k, None)
+			if isinstance(old, RedditUser):
+				old = old.name
+			if old != new.get(k):
+				changed = True
+			try:
+				delattr(self, k)	#decode it again from the new data
+			except AttributeError:
+				pass
+		self.raw = data
+		if not self.session.keep_raw:
+			self.drop_raw()
+		return changed
+
+	def reply(self, text, distinguish=False, queued=False):
+		"""Reply to the thing and return the new comment
+		If queued, send it through the session's ActionScheduler and return a Future (of the new comment) instead of waiting. The same goes for the other actions below."""
+		def parse(response):
+			new_thing = RedditComment(self.session, response["json"]["data"]["things"][0])
+			if new_thing == None:	#the response didn't tell us what the new thing is, so it probably didn't submit successfully
+				raise RuntimeError #FIXME make the error more specific
+			if distinguish:
+				new_thing.distinguish()
+			return new_thing
+		return self.session._write("reply", args={"thing_id":self.name, "text":text}, key=self.name, queued=queued, parse=parse)
+
+	def distinguish(self, distinguish=True, queued=False):
 		"""Distinguish or undistinguish a thing"""
-		self.session.req("distinguish", args={"id":self.name, "how":("yes" if distinguish else "no")})
+		return self.session._write("distinguish", args={"id":self.name, "how":("yes" if distinguish else "no")}, key=self.name, queued=queued)
 
-	def remove(self):
+	def remove(self, queued=False):
 		"""Remove the thing"""
-		self.session.req("remove", args={"id":self.name, "spam":False})
+		return self.session._write("remove", args={"id":self.name, "spam":False}, key=self.name, queued=queued)
 
-	def report(self):
+	def report(self, queued=False):
 		"""Report the thing to the moderators"""
-		self.session.req("report", args={"id":self.name})
+		return self.session._write("report", args={"id":self.name}, key=self.name, queued=queued)
 
 class RedditSubmission(RedditThing):
 	"""A submission (link or self-post), without comments"""
 
-	fields = ["name", "domain", "subreddit", "selftext", "title", "link_flair_css_class", "is_self", "permalink", "url", "created_utc", "num_reports", "id"]
+	fields = ["name", "domain", "subreddit", "selftext", "title", "link_flair_css_class", "is_self", "permalink", "url", "created_utc", "num_reports", "id", "score"]
 	user_fields = ["author", "banned_by", "approved_by"]
 
 	def __str__(self):
@@ -555,7 +1266,9 @@ class RedditSubmission(RedditThing):
 class RedditComment(RedditThing):
 	"""A single comment"""
 
-	fields = ["name", "body", "edited", "created_utc", "num_reports", "subreddit", "link_id", "link_title", "id", "parent_id"]
+	__slots__ = ("replies",)
+
+	fields = ["name", "body", "edited", "created_utc", "num_reports", "subreddit", "link_id", "link_title", "id", "parent_id", "score"]
 	user_fields = ["author", "link_author", "banned_by", "approved_by"]
 
 	def __init__(self, session, data):
@@ -576,17 +1289,167 @@ class RedditMore(RedditThing):
 class RedditThread(RedditThing):
 	"""An entire thread, submission and comments"""
 
-	def __init__(self, session, subm, coms):
+	__slots__ = ("submission", "comments", "missing", "index", "more_counts")
+
+	def __init__(self, session, subm, coms, missing=None, index=None, more_counts=None):
 		self.session = session
 		self.submission = subm
 		self.comments = coms
+		self.missing = missing if missing is not None else []	#ids of hidden comments that weren't fetched
+		self.index = index	#fullname -> RedditComment for every comment in the tree. built by get_index() when it's needed
+		self.more_counts = more_counts	#parent fullname -> count of the RedditMore stub under it, as of the last fetch. see get_thread_delta()
+
+	def get_index(self):
+		"""Return the fullname -> RedditComment index of the tree, building it if it hasn't been yet"""
+		if self.index is None:
+			self.index = {}
+			stack = list(self.comments)
+			while stack:
+				c = stack.pop()
+				self.index[c.name] = c
+				stack.extend(c.replies)
+		return self.index
+
+	def refresh(self, max_requests=None, workers=1):
+		"""Merge in the comments posted since the thread was fetched. See RedditSession.get_thread_delta()."""
+		return self.session.get_thread_delta(self, max_requests=max_requests, workers=workers)
+
+	def flatten(self):
+		"""Return the thread as a FlatThread"""
+		return FlatThread(self.session, self.submission, self.comments, self.missing)
 
 	def __str__(self):
 		return "<RedditThread(%s, %s)>" % (self.submission, self.comments)
 
+class FlatThread():
+	"""A thread's comment tree as parallel arrays, one row per comment in preorder, so the rows under any comment are one contiguous run.
+	The columns are names (fullnames), parents (the parent's row, -1 for top-level comments), depths (0 for top-level), authors (indexes into author_names), created (created_utc) and scores.
+	things holds the RedditComment for each row. Walking, slicing and filtering work on the arrays and never recurse, however deep the thread is.
+
+	Usage:
+		flat = session.get_thread("abc", flat=True)	#or thread.flatten()
+		collections.Counter(flat.depths)					#depth histogram
+		[flat.things[i] for i in flat.select(author="someone")]
+		len(flat.subtree(i))									#comments under row i, including itself
+	"""
+
+	def __init__(self, session, submission, comments, missing=None):
+		self.session = session
+		self.submission = submission
+		self.missing = missing if missing is not None else []
+		self.things = []
+		self.names = []
+		self.parents = array.array("i")
+		self.depths = array.array("i")
+		self.authors = array.array("i")
+		self.author_names = []
+		self.created = array.array("d")
+		self.scores = array.array("q")
+		self.ends = array.array("i")				#the row after the last one in each row's subtree
+		self.child_offsets = array.array("i")	#row i's children are child_rows[child_offsets[i]:child_offsets[i+1]]
+		self.child_rows = array.array("i")
+		self._author_ids = {}
+		self._add(comments)
+		self._index()
+
+	def _add(self, comments):
+		stack = [(c, -1, 0) for c in reversed(comments)]	#not recursive, so deep threads can't hit the recursion limit
+		while stack:
+			c, parent, depth = stack.pop()
+			row = len(self.things)
+			author = getattr(c, "author", None)	#fields missing from the raw data raise AttributeError rather than returning None
+			author = author.name if author is not None else None
+			if author not in self._author_ids:
+				self._author_ids[author] = len(self.author_names)
+				self.author_names.append(author)
+			self.things.append(c)
+			self.names.append(c.name)
+			self.parents.append(parent)
+			self.depths.append(depth)
+			self.authors.append(self._author_ids[author])
+			self.created.append(getattr(c, "created_utc", None) or 0.0)
+			self.scores.append(getattr(c, "score", None) or 0)	#reddit.com sends no score while it's hidden
+			stack.extend((r, row, depth + 1) for r in reversed(c.replies))
+
+	def _index(self):
+		"""Work out ends and the child offsets from parents"""
+		n = len(self.things)
+		self.ends = array.array("i", range(1, n + 1))
+		counts = array.array("i", bytes(4 * (n + 1)))
+		for row in range(n - 1, -1, -1):	#children come after their parents, so one pass from the end gets every subtree
+			p = self.parents[row]
+			if p >= 0:
+				if self.ends[row] > self.ends[p]:
+					self.ends[p] = self.ends[row]
+				counts[p + 1] += 1
+		self.child_offsets = array.array("i", itertools.accumulate(counts))
+		fill = array.array("i", self.child_offsets)
+		self.child_rows = array.array("i", bytes(4 * (n - self.parents.count(-1))))
+		for row in range(n):	#in row order, so siblings keep their order
+			p = self.parents[row]
+			if p >= 0:
+				self.child_rows[fill[p]] = row
+				fill[p] += 1
+
+	def __len__(self):
+		return len(self.things)
+
+	def __getitem__(self, row):
+		return self.things[row]
+
+	def top_level(self):
+		"""Return the rows of the top-level comments"""
+		return [row for row, p in enumerate(self.parents) if p < 0]
+
+	def children(self, row):
+		"""Return the rows of row's direct replies"""
+		return self.child_rows[self.child_offsets[row]:self.child_offsets[row + 1]]
+
+	def subtree(self, row):
+		"""Return the rows of row and everything under it, in preorder"""
+		return range(row, self.ends[row])
+
+	def preorder(self, row=None):
+		"""Yield (row, depth) for every comment (or every comment under row), parents before their replies"""
+		rows = range(len(self.things)) if row is None else self.subtree(row)
+		for r in rows:
+			yield r, self.depths[r]
+
+	def select(self, author=None, min_depth=None, max_depth=None, since=None, until=None, min_score=None, rows=None):
+		"""Return the rows (of all of them, or of rows) that match every filter given, in preorder. since and until bound created_utc."""
+		rows = range(len(self.things)) if rows is None else rows
+		if author is not None:
+			a = self._author_ids.get(author)
+			rows = [r for r in rows if self.authors[r] == a] if a is not None else []
+		if min_depth is not None:
+			rows = [r for r in rows if self.depths[r] >= min_depth]
+		if max_depth is not None:
+			rows = [r for r in rows if self.depths[r] <= max_depth]
+		if since is not None:
+			rows = [r for r in rows if self.created[r] >= since]
+		if until is not None:
+			rows = [r for r in rows if self.created[r] < until]
+		if min_score is not None:
+			rows = [r for r in rows if self.scores[r] >= min_score]
+		return list(rows)
+
+	def to_thread(self):
+		"""Return a RedditThread of the same comments, with their replies lists rebuilt from the rows"""
+		top = []
+		for t in self.things:
+			t.replies = []
+		for row, t in enumerate(self.things):
+			p = self.parents[row]
+			(top if p < 0 else self.things[p].replies).append(t)
+		return RedditThread(self.session, self.submission, top, self.missing, dict(zip(self.names, self.things)))
+
+	def __str__(self):
+		return "<FlatThread(%s, %d comments)>" % (self.submission, len(self.things))
+
 class RedditModaction(RedditThing):
 	"""A 'more' object"""
 
+	__slots__ = ("name",)
 	fields = ["description", "id", "created_utc", "subreddit", "details", "action", "target_fullname"]
 	user_fields = ["mod"]
 
@@ -600,6 +1463,8 @@ class RedditModaction(RedditThing):
 class RedditMessage(RedditThing):
 	"""A message object (inbox or sent)"""
 
+	__slots__ = ("replies",)
+
 	fields = ["body", "was_comment", "first_message", "name", "first_message_name", "created_utc", "body_html", "subreddit", "parent_id", "context", "subject"]
 	user_fields = ["dest", "author"]
 
@@ -620,11 +1485,11 @@ class RedditSubreddit(RedditThing):
 
 	def ban(self, user, note):
 		"""Ban user from subreddit with reason note"""
-		self.req("ban", args={"r":self.name, "name":user, "note":note})
+		self.session.req("ban", args={"r":self.name, "name":user, "note":note})
 
 	def unban(self, user):
 		"""Unban user from subreddit"""
-		self.req("unban", args={"r":self.name, "name":user})
+		self.session.req("unban", args={"r":self.name, "name":user})
 
 	def __str__(self):
 		return "<RedditSubreddit(%s, %s)>" % (self.name, self.display_name)
@@ -643,6 +1508,9 @@ class RedditBan(RedditThing):
 
 class RedditUser:
 	"""A redditor object. Note that this can sometimes be "#subreddit", in which case null_user will be true."""
+
+	__slots__ = ("session", "kind", "name", "null_user")
+
 	def __init__(self, session, name):
 		self.session = session
 		self.kind = "t2"
@@ -670,6 +1538,8 @@ class RedditUser:
 class RedditWikipage(RedditThing):
 	"""A revision of a wiki page"""
 
+	__slots__ = ("user",)
+
 	fields = ["may_revise", "revision_date", "content_html", "content_md"]
 
 	def __init__(self, session, data):
@@ -679,10 +1549,1034 @@ class RedditWikipage(RedditThing):
 	def __str__(self):
 		return "<RedditWikipage(%s)>" % (self.content_md[:30])
 
+class RedditStream():
+	"""Watches many subreddits for new comments (kind="comments") or submissions (kind="submissions") and yields each new one once, oldest first.
+	Subreddits are polled together as r/a+b+c, as many per request as fit in a URL. Each poll pages back from the front only until it reaches what it has already seen.
+	The newest id seen in each subreddit is saved to state_path (if set), so a restarted stream picks up where it left off instead of refetching.
+	Polling speeds up (down to min_interval seconds) while there's activity and slows down (up to max_interval) while there isn't.
+
+	Usage:
+		for comment in RedditStream(session, ["python", "learnpython"], state_path="stream.json"):
+			...
+	"""
+
+	_url_limit = 2000		#keep request URLs shorter than this
+	_seen_limit = 10000	#remember this many recent fullnames, in case ids don't arrive in order
+
+	def __init__(self, session, subreddits, kind="comments", state_path=None, min_interval=5, max_interval=120, max_pages=5):
+		self.session = session
+		self.kind = kind
+		self.state_path = state_path
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.max_pages = max_pages	#never page back further than this in one poll
+		self.interval = min_interval
+		self.groups = self._group([r.lower() for r in subreddits])
+		self.hwm = {}								#subreddit (lowercase) -> id36 of the newest item yielded
+		self.seen = collections.OrderedDict()	#recently yielded fullnames, oldest first
+		self.gaps = {}								#group ("a+b+c") -> [{"after", "marks"}], oldest first: stretches a poll had to stop short of, still to be fetched
+		if state_path is not None:
+			self._load()
+
+	def _group(self, subreddits):
+		"""Split subreddits into a+b+c groups that each fit in a request URL"""
+		groups = []
+		cur = []
+		for r in subreddits:
+			if cur and len("+".join(cur + [r])) + 100 > RedditStream._url_limit:	#100 for the rest of the URL
+				groups.append(cur)
+				cur = []
+			cur.append(r)
+		if cur:
+			groups.append(cur)
+		return groups
+
+	def _load(self):
+		try:
+			with open(self.state_path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):	#no state yet
+			return
+		self.hwm = state.get(self.kind, {})
+		self.gaps = state.get(self.kind + "_gaps", {})
+
+	def _save(self):
+		try:
+			with open(self.state_path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			state = {}
+		state[self.kind] = self.hwm
+		state[self.kind + "_gaps"] = self.gaps
+		tmp = self.state_path + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(state, f)
+		os.replace(tmp, self.state_path)
+
+	def _is_new(self, data, marks):
+		if data["name"] in self.seen:
+			return False
+		hwm = marks.get(data["subreddit"].lower())
+		return hwm is None or int(data["id"], 36) > int(hwm, 36)
+
+	def _poll_group(self, group, after="", marks=None):
+		"""Return the new items in one group, oldest first, the after cursor to carry on from if we stopped paging before reaching what we'd already seen (or None), and the newest id on the first page.
+		Paging goes back to marks (self.hwm by default). after carries on from a poll that stopped short."""
+		marks = self.hwm if marks is None else marks
+		known = [int(marks[r], 36) for r in group if r in marks]
+		floor = min(known) if known else None	#page back until we reach the subreddit we're furthest behind on
+		new = []
+		newest = None
+		n = after
+		for page in range(self.max_pages):
+			items = self.session.req(self.kind, "+".join(group), get_args={"limit":RedditSession._listing_batch, "after":n})
+			children = items["data"]["children"]
+			if newest is None and children:
+				newest = children[0]["data"]["id"]
+			new += [c for c in children if self._is_new(c["data"], marks) and ((page == 0 and not after) or c["data"]["subreddit"].lower() in marks)]	#subreddits we've never polled start from the newest page instead of their whole history
+			n = items["data"]["after"]
+			if floor is None or len(children) == 0 or n is None or any(int(c["data"]["id"], 36) <= floor for c in children):
+				return list(reversed(new)), None, newest
+		return list(reversed(new)), n, newest
+
+	def poll(self):
+		"""Check every subreddit once and return the new items, oldest first within each group
+		A group with more new items than max_pages holds is caught up over the next polls: the rest are fetched from where this poll stopped, before the group's newest ones."""
+		a = []
+		busy = False
+		before = (dict(self.hwm), json.dumps(self.gaps))
+		for group in self.groups:
+			key = "+".join(group)
+			new = []
+			gaps = []
+			for gap in self.gaps.pop(key, []):	#oldest first
+				old, after, _ = self._poll_group(group, gap["after"], gap["marks"])
+				new += old
+				if after is not None:
+					gaps.append({"after":after, "marks":gap["marks"]})
+			marks = {r: self.hwm[r] for r in group if r in self.hwm}
+			front, after, newest = self._poll_group(group)
+			new += front
+			if after is not None:	#everything between here and the old marks is still to be fetched
+				gaps.append({"after":after, "marks":marks})
+			if gaps:
+				self.gaps[key] = gaps
+				busy = True
+			for r in group:
+				if r not in self.hwm and newest is not None:	#quiet subreddits are caught up as of now
+					self.hwm[r] = newest
+			for item in new:
+				data = item["data"]
+				self.seen[data["name"]] = True
+				r = data["subreddit"].lower()
+				if r not in self.hwm or int(data["id"], 36) > int(self.hwm[r], 36):
+					self.hwm[r] = data["id"]
+				a.append(self.session._thing_factory(item))
+		while len(self.seen) > RedditStream._seen_limit:
+			self.seen.popitem(last=False)
+		if (self.hwm, json.dumps(self.gaps)) != before and self.state_path is not None:
+			self._save()
+		if busy:
+			self.interval = self.min_interval	#we fell behind. catch up right away
+		elif a:
+			self.interval = max(self.min_interval, self.interval / 2)
+		else:
+			self.interval = min(self.max_interval, self.interval * 1.5)
+		return a
+
+	def __iter__(self):
+		while True:
+			start = time.time()
+			yield from self.poll()
+			delay = self.interval - (time.time() - start)
+			if delay > 0:
+				time.sleep(delay)
+
+class RedditSessionPool(RedditSession):
+	"""Several RedditSessions (each with its own credentials, token and RateLimiter) behind the RedditSession interface.
+	Reads from endpoints that don't need auth go to whichever member can send soonest (the most budget left, when that's a tie), so the pool's throughput is the sum of its members'.
+	Members send those reads to oauth.reddit.com with their own token (the pool sets their oauth_reads), so each one draws on, and hears back about, its own X-Ratelimit budget rather than sharing the host's anonymous one.
+	Everything else, writes and reads that depend on who's asking (inbox, modlog...), goes to writer.
+
+	Usage:
+		pool = RedditSessionPool([RedditSession(u1, p1, ...), RedditSession(u2, p2, ...)])
+		thread = pool.get_thread("abc")
+		thread.comments[0].reply("hi")	#sent by the first session
+	"""
+
+	def __init__(self, sessions, writer=None, keep_raw=True, archive=None):
+		"""writer is the member that writes and authenticated reads go through (the first one by default).
+		Members should each have their own RateLimiter; ones that share one also share its budget."""
+		self.sessions = list(sessions)
+		if len(self.sessions) == 0:
+			raise ValueError("a pool needs at least one session")
+		self.writer = writer if writer is not None else self.sessions[0]
+		if self.writer not in self.sessions:
+			self.sessions.append(self.writer)
+		for s in self.sessions:
+			s.oauth_reads = True
+		self.keep_raw = keep_raw
+		w = self.writer	#the connection state RedditSession.__init__() would set up is the writer's, so inherited code that reaches for it (e.g. _req()) sends as the writer
+		self.url_base = w.url_base
+		self.retries = w.retries
+		self.oauth_reads = True
+		self.ratelimiter = w.ratelimiter
+		self.http = w.http
+		self.user = w.user
+		self.passwd = w.passwd
+		self.user_agent = w.user_agent
+		self.client_id = w.client_id
+		self.client_secret = w.client_secret
+		self.token_cache = w.token_cache
+		self.tokens = {}		#unused. see _bearer()
+		self.token_lock = threading.Lock()
+		self.inflight = {}
+		self.inflight_lock = threading.Lock()
+		self.cache = None		#each member caches its own responses
+		if isinstance(archive, str):
+			archive = ThingArchive(archive)
+		self.archive = archive
+		self.actions = ActionScheduler(self)	#queued writes still go out through writer
+		self.hooks = []
+		self.metrics = None
+		self.histories = collections.OrderedDict()
+		self.histories_lock = threading.Lock()
+
+	def _session_for(self, url_name, priority):
+		"""Pick the member to send a request to"""
+		u = RedditSession.urls[url_name]
+		if u["auth"] or u["method"] != "get":
+			return self.writer
+		return min(self.sessions, key=lambda s: (s.ratelimiter.delay(priority), -(s.ratelimiter.remaining or 0)))
+
+	def req(self, url_name, rname="", args={}, get_args=None, priority=None):
+		"""Send a request through the member _session_for() picks and return the response body"""
+		return self._session_for(url_name, priority).req(url_name, rname, args, get_args, priority)
+
+	def req_raw(self, url, args={}, hs={}, auth=None, method='get', priority=None, trace=None):
+		return self.writer.req_raw(url, args, hs, auth, method, priority, trace)
+
+	def _bearer(self, rejected=None):
+		return self.writer._bearer(rejected)	#one token for the writer's credentials, not a second login
+
+	def add_hook(self, f):
+		"""Like RedditSession.add_hook(), for requests made by every member"""
+		self.hooks.append(f)
+		for s in self.sessions:
+			s.add_hook(f)
+
+	def remove_hook(self, f):
+		self.hooks.remove(f)
+		for s in self.sessions:
+			s.remove_hook(f)
+
+	def _invalidate(self, url_name, rname):
+		for s in self.sessions:
+			s._invalidate(url_name, rname)
+
+	def close(self):
+		"""Wait for queued actions to go out, then close every member"""
+		self.actions.close()
+		for s in self.sessions:
+			s.close()
+
+class _ThreadBuilder():
+	"""Assembles a thread's comment tree from the thread listing plus any number of morechildren results.
+	Every comment is indexed by fullname, so attaching one to its parent is a dict lookup no matter how big the thread is."""
+
+	def __init__(self, session, link_id, comments=None, index=None, track=False, counts=None):
+		"""To add to an existing tree, pass its top-level comments and index; they're updated in place.
+		With track, comments already in the tree are updated from the new data, and added and changed list what was new and what changed.
+		counts are the RedditMore counts from when the tree was last fetched (see RedditSession._morechildren_batches()). The ones seen this time are collected in more_counts."""
+		self.session = session
+		self.link_id = link_id
+		self.comments = comments if comments is not None else []	#top-level comments, in order
+		self.index = index if index is not None else {}				#fullname -> RedditComment, for every comment in the tree
+		self.mores = []		#RedditMore stubs that haven't been taken by take_mores() yet, in tree order
+		self.orphans = {}		#parent fullname -> comments that arrived before their parent
+		self.track = track
+		self.counts = counts
+		self.more_counts = {}	#parent fullname -> count of the RedditMore stub under it
+		self.added = []
+		self.changed = []
+
+	def add_listing(self, children):
+		"""Add the children of a thread listing, along with their nested replies, in order"""
+		stack = [iter(children)]	#not recursive, so deep threads can't hit the recursion limit
+		while stack:
+			c = next(stack[-1], None)
+			if c is None:
+				stack.pop()
+				continue
+			t = self.add_raw(c)
+			if t is not None and c["data"].get("replies"):	#reddit sends "" when there are none
+				stack.append(iter(c["data"]["replies"]["data"]["children"]))
+
+	def add_raw(self, x):
+		"""add() a thing from its raw JSON. A comment that's already in the tree isn't built again; it's returned (and, when tracking, updated) instead."""
+		old = self.index.get(x["data"].get("name")) if x["kind"] == "t1" else None
+		if old is None:
+			return self.add(self.session._thing_factory(x))
+		if self.track:
+			if self.session.archive is not None:
+				self.session.archive.put((x,))
+			if old.update(x):
+				self.changed.append(old)
+		return old
+
+	def add(self, t):
+		"""Add one comment or RedditMore (e.g. from a morechildren result) to the tree. Return the comment, or None if t wasn't a new comment."""
+		if t.__class__ == RedditMore:
+			if t.children:	#a "continue this thread" link has no children and can't be expanded with morechildren
+				self.mores.append(t)
+				self.more_counts[t.parent_id] = t.count or 0
+			return None
+		if t.__class__ != RedditComment or t.name in self.index:	#morechildren sometimes repeats comments
+			return None
+		self.index[t.name] = t
+		if self.track:
+			self.added.append(t)
+		if t.parent_id == self.link_id:
+			self.comments.append(t)
+		elif t.parent_id in self.index:
+			self.index[t.parent_id].replies.append(t)
+		else:
+			self.orphans.setdefault(t.parent_id, []).append(t)
+		t.replies.extend(self.orphans.pop(t.name, []))
+		return t
+
+	def take_mores(self):
+		"""Return the RedditMore stubs collected so far and forget them"""
+		mores, self.mores = self.mores, []
+		return mores
+
+	def finish(self):
+		"""Return the top-level comments. Comments whose parent never turned up are kept at the top level rather than dropped."""
+		for orphans in self.orphans.values():
+			self.comments.extend(orphans)
+		self.orphans = {}
+		return self.comments
+
+class _Deferred():
+	"""A call that isn't made until its result() is asked for. Stands in for a Future when nothing should run in the background."""
+
+	def __init__(self, f, *args, **kwargs):
+		self.call = functools.partial(f, *args, **kwargs)
+
+	def result(self):
+		return self.call()
+
+class AsyncRedditSession():
+	"""An asyncio front end for RedditSession.
+	Every method in _methods is available here as a coroutine, e.g. await s.get_comments("python"), with the same arguments and results.
+	Up to max_concurrency calls are in flight at once, each running in a worker thread on the session's pooled connections. They all share the session's RateLimiter and token.
+	Things returned from here belong to the underlying RedditSession, so their own methods (reply(), remove(), etc.) block. Use run() to await those: await s.run(comment.remove)"""
+
+	_max_concurrency = 8		#run up to this many requests at once
+
+	_methods = ["req", "req_raw", "get_comments", "get_submissions", "get_user_overview", "get_thread", "get_thread_delta", "get_submission", "get_comment", "get_things", "get_submissions_by_id", "get_comments_by_id", "get_modlog", "get_inbox", "get_sent", "message", "get_user_comments", "get_user_submitted", "get_user_histories", "get_flairlist", "set_flair_bulk", "update_flair", "get_modmail", "get_message", "get_message_modmail", "get_subreddits_subscribed", "get_subreddits_mod", "get_subreddit_about", "get_subreddit_settings", "set_subreddit_settings", "get_banned", "submit", "ban", "unban", "wiki_write", "wiki_get", "sync_comments", "sync_submissions", "sync_modlog", "sync_user", "get_archived"]
+	_local = ["close", "add_hook", "remove_hook", "enable_metrics", "get_user", "flair_diff"]	#public RedditSession methods that don't wait on reddit.com, so they aren't wrapped. use .session for them
+	#the iter_* generators aren't wrapped either. get_* returns the same things, and run() can drive an iterator a step at a time
+
+	def __init__(self, u, p, agent, client_id, client_secret, max_concurrency=_max_concurrency, **kwargs):
+		"""Takes the same arguments as RedditSession. Use from_session() to wrap an existing RedditSession instead."""
+		kwargs.setdefault("pool_size", max_concurrency)	#one connection per worker
+		self._setup(RedditSession(u, p, agent, client_id, client_secret, **kwargs), max_concurrency)
+
+	@classmethod
+	def from_session(cls, session, max_concurrency=_max_concurrency):
+		"""Wrap an existing RedditSession"""
+		self = cls.__new__(cls)
+		self._setup(session, max_concurrency)
+		return self
+
+	def _setup(self, session, max_concurrency):
+		self.session = session
+		self.max_concurrency = max_concurrency
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="lightreddit")
+
+	async def run(self, f, *args, **kwargs):
+		"""Run the blocking callable f in the worker pool and return its result"""
+		return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(f, *args, **kwargs))
+
+	def close(self):
+		"""Stop the worker threads and close the underlying session"""
+		self._executor.shutdown(wait=True)
+		self.session.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await asyncio.get_running_loop().run_in_executor(None, self.close)	#don't block the loop while in-flight requests finish
+
+def _async_method(name):
+	"""Make a coroutine method that runs RedditSession.<name> in the worker pool"""
+	async def method(self, *args, **kwargs):
+		return await self.run(getattr(self.session, name), *args, **kwargs)
+	method.__name__ = name
+	method.__qualname__ = "AsyncRedditSession." + name
+	method.__doc__ = getattr(RedditSession, name).__doc__
+	return method
+
+for _name in AsyncRedditSession._methods:
+	setattr(AsyncRedditSession, _name, _async_method(_name))
+
+class RequestStats():
+	"""Per-endpoint request counts, latency histograms and totals, collected from a RedditSession's hook events (see RedditSession.enable_metrics()).
+	Export them with as_dict() or, in Prometheus' text format, with prometheus()."""
+
+	buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)	#latency histogram upper bounds, in seconds
+
+	def __init__(self):
+		self.endpoints = {}
+		self.lock = threading.Lock()
+
+	def _endpoint(self, name):
+		if name not in self.endpoints:
+			self.endpoints[name] = {"requests":0, "cached":0, "shared":0, "errors":0, "retries":0, "bytes":0, "status":{}, "latency_sum":0.0, "latency_buckets":[0] * len(RequestStats.buckets),
+				"wait_sum":0.0, "parse_sum":0.0, "items":0, "build_sum":0.0}
+		return self.endpoints[name]
+
+	def record(self, event):
+		"""Add one hook event"""
+		with self.lock:
+			e = self._endpoint(event["endpoint"])
+			if event["type"] == "build":
+				e["items"] += event["items"]
+				e["build_sum"] += event["seconds"]
+				return
+			e["requests"] += 1
+			e["cached"] += event["cached"]
+			e["shared"] += event.get("shared", False)
+			e["errors"] += event["error"] is not None
+			e["retries"] += event["retries"]
+			e["bytes"] += event["bytes"]
+			e["wait_sum"] += event["wait"]
+			e["parse_sum"] += event["parse"]
+			if event["status"] is not None:
+				e["status"][event["status"]] = e["status"].get(event["status"], 0) + 1
+			if not event["cached"]:
+				e["latency_sum"] += event["latency"]
+				for i, le in enumerate(RequestStats.buckets):
+					if event["latency"] <= le:
+						e["latency_buckets"][i] += 1
+						break
+
+	def as_dict(self):
+		"""A copy of the stats, keyed by endpoint name. latency_buckets counts requests in each of the buckets ranges (not cumulatively)."""
+		with self.lock:
+			return json.loads(json.dumps(self.endpoints))
+
+	def prometheus(self, prefix="lightreddit"):
+		"""The stats in Prometheus' text exposition format"""
+		stats = self.as_dict()
+		lines = []
+		def metric(name, kind, helptext, values):
+			lines.append("# HELP %s_%s %s" % (prefix, name, helptext))
+			lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+			for labels, v in values:
+				lines.append("%s_%s{%s} %s" % (prefix, name, ",".join('%s="%s"' % l for l in labels), repr(float(v)) if isinstance(v, float) else v))
+		for name, key, helptext in [("requests_total", "requests", "Requests made, including ones served from the cache"), ("cache_hits_total", "cached", "Requests served from the response cache or an identical request in flight"),
+				("coalesced_total", "shared", "Requests that shared the response of an identical request in flight"),
+				("errors_total", "errors", "Requests that raised an exception"), ("retries_total", "retries", "Requests resent after a 429 or 401"),
+				("received_bytes_total", "bytes", "Bytes of response bodies received"), ("items_built_total", "items", "Things built from listings")]:
+			metric(name, "counter", helptext, [((("endpoint", ep),), e[key]) for ep, e in sorted(stats.items())])
+		for name, key, helptext in [("ratelimit_wait_seconds_total", "wait_sum", "Seconds requests were held by the rate limiter"), ("parse_seconds_total", "parse_sum", "Seconds spent decoding JSON"),
+				("build_seconds_total", "build_sum", "Seconds spent building things from listings")]:
+			metric(name, "counter", helptext, [((("endpoint", ep),), e[key]) for ep, e in sorted(stats.items())])
+		metric("responses_total", "counter", "Responses by HTTP status", [((("endpoint", ep), ("status", code)), n) for ep, e in sorted(stats.items()) for code, n in sorted(e["status"].items())])
+		values = []
+		for ep, e in sorted(stats.items()):
+			count = 0
+			for le, n in zip(RequestStats.buckets, e["latency_buckets"]):
+				count += n
+				values.append(((("endpoint", ep), ("le", str(le))), count))
+			network = e["requests"] - e["cached"]
+			values.append(((("endpoint", ep), ("le", "+Inf")), network))
+		lines.append("# HELP %s_request_latency_seconds Seconds spent on the network per request" % (prefix))
+		lines.append("# TYPE %s_request_latency_seconds histogram" % (prefix))
+		for labels, v in values:
+			lines.append("%s_request_latency_seconds_bucket{%s} %s" % (prefix, ",".join('%s="%s"' % l for l in labels), v))
+		for ep, e in sorted(stats.items()):
+			lines.append('%s_request_latency_seconds_sum{endpoint="%s"} %r' % (prefix, ep, e["latency_sum"]))
+			lines.append('%s_request_latency_seconds_count{endpoint="%s"} %d' % (prefix, ep, e["requests"] - e["cached"]))
+		return "\n".join(lines) + "\n"
+
+class ActionScheduler():
+	"""Sends queued requests (mostly moderation actions) from background threads, lowest priority number first.
+	submit() returns a concurrent.futures.Future right away. Submitting an action that's identical to one still waiting returns the waiting one's Future instead of sending it twice.
+	Failures that might go away are retried up to retries times, backing off exponentially from backoff seconds.
+	Writes marked "idempotent" in RedditSession.urls (remove, ban, etc.) are retried after connection errors, 5xx and 429s. Others (a reply, say) may have gone through before the failure, so they're only retried when they can't have reached reddit.com: after a 429, or a connection that was never made."""
+
+	URGENT = 0			#moderation actions. these also skip ahead of normal requests in the RateLimiter
+	NORMAL = 5			#ordinary reads
+	BACKGROUND = 10	#bulk work that can wait
+
+	def __init__(self, session, workers=1, retries=3, backoff=2.0):
+		self.session = session
+		self.workers = workers
+		self.retries = retries
+		self.backoff = backoff
+		self.queue = queue.PriorityQueue()
+		self.pending = {}					#dedup key -> Future, for actions that haven't finished
+		self.threads = []
+		self.order = itertools.count()	#keeps equal priorities first-in, first-out
+		self.lock = threading.Lock()
+
+	def submit(self, url_name, rname="", args={}, priority=URGENT, key=None, parse=None):
+		"""Queue session.req(url_name, rname, args) and return a Future of its response (or of parse(response), if parse is set).
+		key is what the action is done to (usually a fullname). It's used to recognize duplicates."""
+		dedup = (url_name, rname, key, tuple(sorted((k, str(v)) for k, v in args.items())))
+		with self.lock:
+			if dedup in self.pending:
+				return self.pending[dedup]
+			f = concurrent.futures.Future()
+			self.pending[dedup] = f
+			if len(self.threads) < self.workers:
+				self._start()
+		self._put(priority, (dedup, url_name, rname, args, priority, parse, f, 0))
+		return f
+
+	def _start(self):
+		for i in range(self.workers - len(self.threads)):
+			t = threading.Thread(target=self._work, name="lightreddit-actions", daemon=True)
+			t.start()
+			self.threads.append(t)
+
+	def _put(self, priority, action):
+		self.queue.put((priority, next(self.order), action))
+
+	def _work(self):
+		while True:
+			priority, n, action = self.queue.get()
+			if action is None:
+				break
+			dedup, url_name, rname, args, priority, parse, f, attempt = action
+			try:
+				response = self.session.req(url_name, rname, args, priority=priority)
+				result = parse(response) if parse else response
+			except Exception as e:
+				u = self.session.urls[url_name]
+				if attempt < self.retries and self._retryable(e, u["method"] == "get" or u.get("idempotent", False)):
+					delay = self.backoff * 2 ** attempt
+					threading.Timer(delay, self._put, (priority, action[:-1] + (attempt + 1,))).start()	#don't hold up the rest of the queue while we wait
+					continue
+				self._finish(dedup)
+				f.set_exception(e)
+			else:
+				self._finish(dedup)
+				f.set_result(result)
+
+	def _finish(self, dedup):
+		with self.lock:
+			del self.pending[dedup]
+
+	@staticmethod
+	def _retryable(e, idempotent=True):
+		status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+		if status == 429:	#rejected before it was carried out
+			return True
+		if isinstance(e, requests.ConnectTimeout) or (isinstance(e, requests.ConnectionError) and e.args and isinstance(getattr(e.args[0], "reason", None), urllib3.exceptions.ConnectTimeoutError)):	#never got a connection (NewConnectionError is a ConnectTimeoutError too)
+			return True
+		if not idempotent:
+			return False
+		return isinstance(e, (requests.ConnectionError, requests.Timeout)) or (status is not None and status >= 500)
+
+	def close(self):
+		"""Wait until everything queued so far has been sent (including retries), then stop the worker threads"""
+		while True:
+			with self.lock:
+				waiting = list(self.pending.values())
+				if len(waiting) == 0:
+					threads, self.threads = self.threads, []
+					break
+			concurrent.futures.wait(waiting)
+		for t in threads:
+			self.queue.put((float("inf"), next(self.order), None))
+		for t in threads:
+			t.join()
+
+class RateLimiter():
+	"""Paces requests to reddit.com.
+	Until reddit.com tells us our budget (the X-Ratelimit-* headers, which it sends on oauth requests), requests are spaced interval seconds apart.
+	After that, the remaining budget is spread evenly over what's left of the reset window, and up to burst requests may go out back-to-back while there is budget to spare.
+	Urgent requests (priority below ActionScheduler.NORMAL) don't queue behind normal ones. The last reserve requests of each window are kept back for them.
+	A 429 blocks everything until its Retry-After has passed."""
+
+	def __init__(self, interval=1.0, burst=5, reserve=10):
+		self.default_interval = interval
+		self.interval = interval	#current spacing between requests
+		self.burst = burst
+		self.reserve_budget = reserve
+		self.urgent_next = 0			#when the next urgent request may go out
+		self.remaining = None		#requests left in the current window, according to reddit.com
+		self.used = None				#requests used in the current window, according to reddit.com
+		self.reset_time = None		#when the current window ends
+		self.tat = time.time()		#when the next request would go out if there were no bursting (GCRA's theoretical arrival time)
+		self.blocked_until = 0		#nothing goes out before this. set by 429s and empty budgets
+		self.requests = 0				#number of requests paced so far
+		self.waited = 0.0				#total seconds callers have been made to wait
+		self.last_wait = 0.0			#seconds the most recent caller had to wait
+		self.lock = threading.Lock()
+
+	def reserve(self, priority=None):
+		"""Claim the next request slot and return how many seconds the caller has to wait before using it"""
+		with self.lock:
+			now = time.time()
+			send_at = self._send_at(now, priority)
+			if priority is not None and priority < ActionScheduler.NORMAL:
+				self.urgent_next = send_at + self._urgent_interval(now)
+				self.tat = max(self.tat, now) + self.interval	#make normal requests pay for it
+			else:
+				self.tat = max(self.tat, send_at) + self.interval
+			self.requests += 1
+			self.last_wait = send_at - now
+			self.waited += self.last_wait
+			return self.last_wait
+
+	def _urgent_interval(self, now):
+		"""The spacing between urgent requests. Normally the same as everyone's, but once normal requests are down to the reserve (and self.interval has grown to the rest of the window), the reserve is spread over the window instead."""
+		if self.reset_time is None or self.reset_time <= now or self.remaining is None:
+			return self.interval
+		return min(self.interval, (self.reset_time - now) / max(min(self.remaining, self.reserve_budget), 1))
+
+	def _send_at(self, now, priority):
+		if priority is not None and priority < ActionScheduler.NORMAL:
+			return max(now, self.urgent_next, self.blocked_until)	#skip ahead of the slots normal requests have already claimed
+		burst = self.burst if self.remaining is not None and self.remaining > self.burst + self.reserve_budget else 1	#only burst when we know there's budget for it
+		return max(now, self.tat - (burst - 1) * self.interval, self.blocked_until)
+
+	def delay(self, priority=None):
+		"""Return how many seconds a request sent now would have to wait, without claiming a slot"""
+		with self.lock:
+			now = time.time()
+			return self._send_at(now, priority) - now
+
+	def wait(self, priority=None):
+		"""Block until the caller may send a request. Return the number of seconds slept."""
+		delay = self.reserve(priority)
+		if delay > 0:
+			time.sleep(delay)
+		return delay
+
+	def update(self, headers, status=200):
+		"""Adjust the pace using the headers (and status code) of a response"""
+		with self.lock:
+			now = time.time()
+			try:
+				self.remaining = float(headers["X-Ratelimit-Remaining"])
+				self.reset_time = now + float(headers["X-Ratelimit-Reset"])
+				self.used = float(headers.get("X-Ratelimit-Used", 0))
+			except (KeyError, ValueError):
+				pass	#not an oauth response, or reddit.com changed something. keep the old numbers
+			if self.reset_time is not None and self.reset_time > now:
+				if self.remaining < 1:
+					self.blocked_until = max(self.blocked_until, self.reset_time)
+				else:
+					self.interval = (self.reset_time - now) / max(self.remaining - self.reserve_budget, 1)	#normal requests leave the reserve alone
+			if status == 429:
+				try:
+					delay = float(headers["Retry-After"])
+				except (KeyError, ValueError):	#missing, or an HTTP date. fall back to the end of the window
+					delay = self.reset_time - now if self.reset_time is not None and self.reset_time > now else 10 * self.default_interval
+				self.blocked_until = max(self.blocked_until, now + delay)
+
+class SharedRateLimiter(RateLimiter):
+	"""A RateLimiter whose state lives in a file, so every process (and session) using the same file draws from one budget.
+	By default the file is picked by client_id and user, in this user's cache directory (see _private_dir()), which makes all of this user's bots on a host that share an account share its rate limit.
+	To share a budget between users, give them a path in a directory they can all write to. Files owned by another user are refused, though, so that's only for trusted setups where they all run as one uid.
+	Request slots are handed out first come, first served across all of them, and each process' use is recorded under name; see usage()."""
+
+	_shared = ("interval", "urgent_next", "remaining", "used", "reset_time", "tat", "blocked_until")
+	_usage_ttl = 3600	#forget processes that haven't made a request for this many seconds
+
+	def __init__(self, client_id, user, path=None, interval=1.0, burst=5, reserve=10, name=None):
+		super(SharedRateLimiter, self).__init__(interval, burst, reserve)
+		if path is None:
+			key = hashlib.sha1(("%s:%s" % (client_id, user)).encode()).hexdigest()[:16]
+			path = os.path.join(_private_dir(), "ratelimit-%s.json" % (key))
+		self.path = path
+		self.name = name or "%s[%d]" % (os.path.basename(sys.argv[0] if sys.argv and sys.argv[0] else "python"), os.getpid())
+
+	@contextlib.contextmanager
+	def _state(self):
+		"""Hold the file lock, with the shared state loaded into self, and write it back at the end. Yields the whole state dict."""
+		with _locked_file(self.path):
+			try:
+				with os.fdopen(_open_private(self.path, os.O_RDONLY)) as f:
+					state = json.load(f)
+			except (OSError, ValueError):	#missing, corrupt or not ours. start a new budget
+				state = {}
+			for k in SharedRateLimiter._shared:
+				if k in state:
+					setattr(self, k, state[k])
+			yield state
+			for k in SharedRateLimiter._shared:
+				state[k] = getattr(self, k)
+			_write_private(self.path, json.dumps(state))
+
+	def reserve(self, priority=None):
+		with self._state() as state:
+			delay = super(SharedRateLimiter, self).reserve(priority)
+			now = time.time()
+			users = {k: v for k, v in state.get("users", {}).items() if v["last"] > now - SharedRateLimiter._usage_ttl}
+			u = users.setdefault(self.name, {"requests":0, "waited":0.0})
+			u["requests"] += 1
+			u["waited"] += delay
+			u["last"] = now
+			state["users"] = users
+		return delay
+
+	def delay(self, priority=None):
+		with self._state():
+			return super(SharedRateLimiter, self).delay(priority)
+
+	def update(self, headers, status=200):
+		with self._state():
+			super(SharedRateLimiter, self).update(headers, status)
+
+	def usage(self):
+		"""Return {name: {"requests", "waited" (seconds), "last" (time of the last request)}} for every process that has drawn from the budget lately"""
+		with self._state() as state:
+			return dict(state.get("users", {}))
+
+class ResponseCache():
+	"""A TTL + LRU cache of response bodies, used by RedditSession.req() for endpoints with a "cache" entry in RedditSession.urls.
+	Up to size responses are kept in memory. If path is set, they're also kept on disk in that directory (again up to size), so they survive restarts and can be shared between processes.
+	hits and misses count lookups."""
+
+	def __init__(self, size=256, path=None):
+		self.size = size
+		self.path = path
+		self.entries = collections.OrderedDict()	#key -> (expiry time, body), least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+		if path is not None:
+			os.makedirs(path, exist_ok=True)
+
+	def get(self, key):
+		"""Return the cached body for key, or None if there isn't a fresh one"""
+		with self.lock:
+			e = self.entries.get(key)
+			if e is None and self.path is not None:
+				e = self._disk_get(key)
+				if e is not None:
+					self._remember(key, e)
+			if e is None or e[0] <= time.time():
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return e[1]
+
+	def put(self, key, body, ttl):
+		"""Cache body under key for ttl seconds"""
+		with self.lock:
+			e = (time.time() + ttl, body)
+			self._remember(key, e)
+			if self.path is not None:
+				self._disk_put(key, e)
+
+	def invalidate(self, url_name=None, rname=None):
+		"""Forget cached responses for url_name (all endpoints if None) and rname (all of them if None)"""
+		match = lambda key: (url_name is None or key[0] == url_name) and (rname is None or key[1] == rname)
+		with self.lock:
+			for key in [k for k in self.entries if match(k)]:
+				del self.entries[key]
+			if self.path is not None:
+				for f, key, e in self._disk_entries():
+					if match(key):
+						self._unlink(f)
+
+	def clear(self):
+		"""Forget everything"""
+		self.invalidate()
+
+	def _remember(self, key, e):
+		self.entries[key] = e
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	def _file(self, key):
+		return os.path.join(self.path, hashlib.sha1(json.dumps(key).encode()).hexdigest())
+
+	def _disk_get(self, key):
+		try:
+			with open(self._file(key), "rb") as f:
+				header = json.loads(f.readline())
+				body = f.read()
+		except (OSError, ValueError):
+			return None
+		if tuple(header["key"]) != key:	#hash collision
+			return None
+		os.utime(self._file(key))	#the mtime is our LRU order on disk
+		return (header["expires"], body)
+
+	def _disk_put(self, key, e):
+		tmp = "%s.%d.tmp" % (self._file(key), os.getpid())
+		with open(tmp, "wb") as f:
+			f.write(json.dumps({"key":key, "expires":e[0]}).encode() + b"\n")
+			f.write(e[1])
+		os.replace(tmp, self._file(key))
+		files = [f for f in os.listdir(self.path) if not f.endswith(".tmp")]
+		if len(files) > self.size:
+			files.sort(key=lambda f: self._mtime(os.path.join(self.path, f)))
+			for f in files[:len(files) - self.size]:
+				self._unlink(os.path.join(self.path, f))
+
+	def _disk_entries(self):
+		"""Yield (filename, key, (expiry, None)) for every response cached on disk"""
+		for f in os.listdir(self.path):
+			if f.endswith(".tmp"):
+				continue
+			f = os.path.join(self.path, f)
+			try:
+				with open(f, "rb") as fh:
+					header = json.loads(fh.readline())
+			except (OSError, ValueError):
+				continue
+			yield f, tuple(header["key"]), (header["expires"], None)
+
+	@staticmethod
+	def _mtime(f):
+		try:
+			return os.path.getmtime(f)
+		except OSError:	#another process removed it
+			return 0
+
+	@staticmethod
+	def _unlink(f):
+		try:
+			os.remove(f)
+		except OSError:
+			pass
+
+class TokenCache():
+	"""A file-backed store of OAuth access tokens, keyed by client_id and user.
+	Any number of sessions and processes can share one file; reads and writes are serialized with a lock file.
+	By default the file is tokens.json in this user's cache directory (see _private_dir()). Files owned by another user are never read from or written to."""
+
+	def __init__(self, path=None):
+		if path is None:
+			path = os.path.join(_private_dir(), "tokens.json")
+		self.path = path
+
+	def _locked(self):
+		"""Hold an exclusive lock on the cache while reading or rewriting it"""
+		return _locked_file(self.path)
+
+	def _read(self):
+		try:
+			with os.fdopen(_open_private(self.path, os.O_RDONLY)) as f:
+				return json.load(f)
+		except (OSError, ValueError):	#missing, corrupt or not ours. either way, start over
+			return {}
+
+	def _write(self, tokens):
+		_write_private(self.path, json.dumps(tokens))	#tokens are secrets, so only we may read them
+
+	@staticmethod
+	def _key(client_id, user):
+		return "%s:%s" % (client_id, user)
+
+	def get(self, client_id, user):
+		"""Return the cached token dict for client_id and user, or None if there isn't an unexpired one"""
+		with self._locked():
+			t = self._read().get(TokenCache._key(client_id, user))
+		if t and t["expires"] > time.time():
+			return t
+		return None
+
+	def put(self, client_id, user, token):
+		"""Store a token dict ({"bearer":..., "expires":...}) for client_id and user"""
+		with self._locked():
+			now = time.time()
+			tokens = {k: v for k, v in self._read().items() if v["expires"] > now}	#drop expired tokens while we're here
+			tokens[TokenCache._key(client_id, user)] = token
+			self._write(tokens)
+
+	def discard(self, client_id, user, bearer=None):
+		"""Remove the token for client_id and user. If bearer is set, only remove it if it's still that token (another process may have already replaced it)."""
+		with self._locked():
+			tokens = self._read()
+			t = tokens.get(TokenCache._key(client_id, user))
+			if t and (bearer is None or t["bearer"] == bearer):
+				del tokens[TokenCache._key(client_id, user)]
+				self._write(tokens)
+
+class ThingArchive():
+	"""A local SQLite store of things (comments, submissions, messages and modlog entries), keyed by fullname so the latest copy of each one wins.
+	Things are indexed by subreddit, author (or mod, for modlog entries) and created_utc, so query() stays fast on big archives.
+	It also keeps the high-water marks that RedditSession.sync_comments() etc. resume from. One archive can be shared by several sessions and threads."""
+
+	_authors = {"t1":"author", "t3":"author", "t4":"author", "modaction":"mod"}	#kinds that are archived -> their author field
+
+	def __init__(self, path):
+		self.path = path
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.local = threading.local()	#rows collected by batch(), per thread
+		with self.lock:
+			self.db.execute("PRAGMA journal_mode=WAL")	#readers in other processes don't block writes
+			self.db.execute("PRAGMA synchronous=NORMAL")
+			self.db.execute("CREATE TABLE IF NOT EXISTS things (name TEXT PRIMARY KEY, kind TEXT, subreddit TEXT COLLATE NOCASE, author TEXT COLLATE NOCASE, created_utc REAL, data TEXT)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS things_subreddit ON things (subreddit, created_utc)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS things_author ON things (author, created_utc)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS things_created ON things (created_utc)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS marks (listing TEXT PRIMARY KEY, name TEXT, updated REAL)")
+			self.db.commit()
+
+	def _rows(self, items):
+		rows = []
+		for x in items:
+			field = ThingArchive._authors.get(x.get("kind"))
+			if field is None:	#"more" stubs, subreddits, wiki pages...
+				continue
+			d = x["data"]
+			name = d.get("name") or d.get("id")
+			if not name:
+				continue
+			if isinstance(d.get("replies"), dict):	#the replies are archived as things of their own
+				d = dict(d, replies="")
+			rows.append((name, x["kind"], d.get("subreddit"), d.get(field), d.get("created_utc"), json.dumps(d)))
+		return rows
+
+	def put(self, items):
+		"""Store raw things ({"kind":..., "data":...} dicts), replacing any older copies. Kinds that aren't archived are skipped."""
+		rows = self._rows(items)
+		pending = getattr(self.local, "rows", None)
+		if pending is not None:
+			pending += rows
+		elif rows:
+			self._write(rows)
+
+	def _write(self, rows):
+		with self.lock:
+			with self.db:	#one transaction
+				self.db.executemany("INSERT OR REPLACE INTO things VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""Hold this thread's put()s until the end of the with block and write them in one transaction"""
+		if getattr(self.local, "rows", None) is not None:	#already in a batch
+			yield
+			return
+		self.local.rows = []
+		try:
+			yield
+		finally:
+			rows, self.local.rows = self.local.rows, None
+			if rows:
+				self._write(rows)
+
+	def get(self, fullname):
+		"""Return the archived raw thing for fullname, or None"""
+		with self.lock:
+			r = self.db.execute("SELECT kind, data FROM things WHERE name = ?", (fullname,)).fetchone()
+		return {"kind":r[0], "data":_json_loads(r[1])} if r else None
+
+	def query(self, kind=None, subreddit=None, author=None, since=None, until=None, limit=None):
+		"""Return raw things, newest first. Every filter is optional:
+		kind is a thing kind ("t1" comments, "t3" submissions, "t4" messages, "modaction"), subreddit and author are names (matched case-insensitively), and since and until bound created_utc."""
+		where = []
+		params = []
+		for column, op, value in (("kind", "=", kind), ("subreddit", "=", subreddit), ("author", "=", author), ("created_utc", ">=", since), ("created_utc", "<", until)):
+			if value is not None:
+				where.append("%s %s ?" % (column, op))
+				params.append(value)
+		sql = "SELECT kind, data FROM things"
+		if where:
+			sql += " WHERE " + " AND ".join(where)
+		sql += " ORDER BY created_utc DESC"
+		if limit is not None:
+			sql += " LIMIT ?"
+			params.append(limit)
+		with self.lock:
+			rows = self.db.execute(sql, params).fetchall()
+		return [{"kind":k, "data":_json_loads(d)} for k, d in rows]
+
+	def get_mark(self, listing):
+		"""Return the fullname of the newest item synced from listing, or None"""
+		with self.lock:
+			r = self.db.execute("SELECT name FROM marks WHERE listing = ?", (listing,)).fetchone()
+		return r[0] if r else None
+
+	def set_mark(self, listing, name):
+		with self.lock:
+			with self.db:
+				self.db.execute("INSERT OR REPLACE INTO marks VALUES (?, ?, ?)", (listing, name, time.time()))
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+def _private_dir():
+	"""Return this user's lightreddit cache directory ($XDG_CACHE_HOME/lightreddit, or ~/.cache/lightreddit), creating it if needed.
+	It's kept at mode 0700. Raises PermissionError if another user owns it."""
+	base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	path = os.path.join(base, "lightreddit")
+	os.makedirs(path, mode=0o700, exist_ok=True)
+	if hasattr(os, "getuid"):
+		st = os.stat(path)
+		if st.st_uid != os.getuid():
+			raise PermissionError("%s is owned by another user" % (path))
+		if st.st_mode & 0o077:
+			os.chmod(path, 0o700)
+	return path
+
+def _open_private(path, flags):
+	"""os.open() path without following symlinks, refusing it if another user owns it (it may have been planted to read our secrets or feed us its own)"""
+	fd = os.open(path, flags | getattr(os, "O_NOFOLLOW", 0), 0o600)
+	if hasattr(os, "getuid") and os.fstat(fd).st_uid != os.getuid():
+		os.close(fd)
+		raise PermissionError("%s is owned by another user" % (path))
+	return fd
+
+def _write_private(path, data):
+	"""Atomically replace path with data (a str), through a new temp file in the same directory that only we can read"""
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "w") as f:
+			f.write(data)
+		os.replace(tmp, path)
+	except BaseException:
+		try:
+			os.unlink(tmp)
+		except OSError:
+			pass
+		raise
+
+@contextlib.contextmanager
+def _locked_file(path):
+	"""Hold an exclusive lock on path (through path.lock), for files that several processes read and rewrite"""
+	fd = _open_private(path + ".lock", os.O_RDWR | os.O_CREAT)
+	try:
+		if fcntl:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+		yield
+	finally:
+		os.close(fd)	#this releases the lock too
+
 class NoSuchUserException(Exception):
 	"""Also shadowbanned users"""
 	pass
 
+class NoSuchThingException(Exception):
+	"""reddit.com didn't return some of the things asked for. missing is the list of their fullnames."""
+	def __init__(self, missing):
+		super(NoSuchThingException, self).__init__("not found: %s" % (", ".join(missing)))
+		self.missing = missing
+
+class IncompleteFetchException(Exception):
+	"""A listing or thread fetch failed partway, even after retrying. cursor holds what was fetched ("items" for listings, "thread" for threads) and where to carry on from.
+	Pass the cursor back as resume to the same method, with the same arguments, to pick up from the failed request. The original error is the exception's __cause__."""
+	def __init__(self, cursor):
+		super(IncompleteFetchException, self).__init__("fetch interrupted; resume with this exception's cursor")
+		self.cursor = cursor
+
 class BadSettingsException(Exception):
 	"""The library raises this before attempting to call site_admin with wonky-looking parameters"""
 	pass
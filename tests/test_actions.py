@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+"""ActionScheduler's retries and dedup, and RateLimiter's pacing, against a fake session and a fake clock."""
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lightreddit
+requests = lightreddit.requests
+
+def http_error(status):
+	r = requests.Response()
+	r.status_code = status
+	return requests.HTTPError("%d error" % status, response=r)
+
+class FakeSession():
+	"""Stands in for RedditSession: req() raises the queued failures in order, then succeeds"""
+	urls = lightreddit.RedditSession.urls
+
+	def __init__(self, failures=()):
+		self.failures = list(failures)
+		self.calls = []
+		self.release = threading.Event()
+		self.release.set()
+
+	def req(self, url_name, rname="", args={}, priority=None):
+		self.calls.append((url_name, rname, dict(args)))
+		self.release.wait()
+		if self.failures:
+			raise self.failures.pop(0)
+		return {"ok":url_name}
+
+class ActionSchedulerTest(unittest.TestCase):
+	def run_action(self, session, url_name):
+		scheduler = lightreddit.ActionScheduler(session, backoff=0)
+		f = scheduler.submit(url_name, args={"id":"t1_a"}, key="t1_a")
+		e = f.exception(timeout=5)
+		scheduler.close()
+		return f, e
+
+	def test_reply_not_retried_after_read_timeout(self):
+		session = FakeSession([requests.ReadTimeout("read timed out")])
+		f, e = self.run_action(session, "reply")
+		self.assertIsInstance(e, requests.ReadTimeout)
+		self.assertEqual(len(session.calls), 1)
+
+	def test_reply_retried_after_429(self):
+		session = FakeSession([http_error(429)])
+		f, e = self.run_action(session, "reply")
+		self.assertIsNone(e)
+		self.assertEqual(len(session.calls), 2)
+
+	def test_remove_retried_after_503(self):
+		session = FakeSession([http_error(503)])
+		f, e = self.run_action(session, "remove")
+		self.assertIsNone(e)
+		self.assertEqual(f.result(), {"ok":"remove"})
+		self.assertEqual(len(session.calls), 2)
+
+	def test_remove_gives_up_after_retries(self):
+		session = FakeSession([http_error(503)] * 4)
+		f, e = self.run_action(session, "remove")
+		self.assertEqual(e.response.status_code, 503)
+		self.assertEqual(len(session.calls), 4)
+
+	def test_duplicates_share_a_future(self):
+		session = FakeSession()
+		session.release.clear()		#hold the first action until everything is submitted
+		scheduler = lightreddit.ActionScheduler(session, backoff=0)
+		first = scheduler.submit("remove", args={"id":"t1_a", "spam":False}, key="t1_a")
+		again = scheduler.submit("remove", args={"spam":False, "id":"t1_a"}, key="t1_a")
+		other = scheduler.submit("remove", args={"id":"t1_b", "spam":False}, key="t1_b")
+		self.assertIs(first, again)
+		self.assertIsNot(first, other)
+		session.release.set()
+		scheduler.close()
+		self.assertEqual(len(session.calls), 2)
+		later = scheduler.submit("remove", args={"id":"t1_a", "spam":False}, key="t1_a")	#the first one has finished, so this is sent again
+		self.assertIsNot(first, later)
+		later.result(timeout=5)
+		scheduler.close()
+
+class RateLimiterTest(unittest.TestCase):
+	def setUp(self):
+		patcher = mock.patch("lightreddit.time.time", return_value=1000.0)
+		self.clock = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_reads_are_spaced(self):
+		limiter = lightreddit.RateLimiter(interval=1.0, reserve=0)
+		self.assertEqual([limiter.reserve(lightreddit.ActionScheduler.NORMAL) for i in range(3)], [0, 1, 2])
+
+	def test_urgent_skips_claimed_reads(self):
+		limiter = lightreddit.RateLimiter(interval=1.0, reserve=0)
+		for i in range(3):
+			limiter.reserve(lightreddit.ActionScheduler.NORMAL)
+		self.assertEqual(limiter.delay(lightreddit.ActionScheduler.URGENT), 0)
+		self.assertEqual(limiter.reserve(lightreddit.ActionScheduler.URGENT), 0)
+		self.assertEqual(limiter.reserve(lightreddit.ActionScheduler.URGENT), 1)	#urgent requests are still spaced among themselves
+		self.assertEqual(limiter.reserve(lightreddit.ActionScheduler.NORMAL), 5)	#and reads pay for the slots they took
+
+	def test_429_blocks_urgent_too(self):
+		limiter = lightreddit.RateLimiter(interval=1.0, reserve=0)
+		limiter.update({"Retry-After":"30"}, status=429)
+		self.assertEqual(limiter.delay(lightreddit.ActionScheduler.URGENT), 30)
+		self.clock.return_value = 1030.0
+		self.assertEqual(limiter.delay(lightreddit.ActionScheduler.URGENT), 0)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+"""AsyncRedditSession keeps up with RedditSession's public methods."""
+
+import inspect
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lightreddit
+
+class AsyncMethodsTest(unittest.TestCase):
+	def test_every_public_method_is_wrapped(self):
+		public = [n for n, f in vars(lightreddit.RedditSession).items() if not n.startswith("_") and not n.startswith("iter_") and callable(getattr(lightreddit.RedditSession, n))]
+		unwrapped = [n for n in public if n not in lightreddit.AsyncRedditSession._methods and n not in lightreddit.AsyncRedditSession._local]
+		self.assertEqual(unwrapped, [])
+
+	def test_wrappers_are_coroutines(self):
+		for n in lightreddit.AsyncRedditSession._methods:
+			self.assertTrue(inspect.iscoroutinefunction(getattr(lightreddit.AsyncRedditSession, n)), n)
+
+if __name__ == "__main__":
+	unittest.main()
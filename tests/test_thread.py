@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""get_thread() against the stand-in server in benchmarks/stub_server.py: every comment comes back, in the thread's order, under its parent."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import lightreddit
+from stub_server import StubReddit, b36
+
+def make_session(base_url):
+	"""A session pointed at the stub that doesn't wait between requests"""
+	s = lightreddit.RedditSession("test", "test", "lightreddit tests", "test", "test", token_cache=False, cache=False, ratelimiter=lightreddit.RateLimiter(interval=0, reserve=0))
+	s.url_base = base_url
+	return s
+
+def expected_preorder(stub):
+	"""The stub's comment tree in preorder, as fullnames, without the deleted ones"""
+	a = []
+	stack = list(reversed(stub.kids[0]))
+	while stack:
+		i = stack.pop()
+		if i in stub.deleted:
+			continue
+		a.append("t1_" + b36(i))
+		stack.extend(reversed(stub.kids.get(i, [])))
+	return a
+
+def preorder(comments):
+	a = []
+	stack = list(reversed(comments))
+	while stack:
+		c = stack.pop()
+		a.append(c)
+		stack.extend(reversed(c.replies))
+	return a
+
+class ThreadTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.stub = StubReddit(thread_size=1500, thread_shown=200, listing_size=10, flair_size=10)
+		cls.session = make_session(cls.stub.start())
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.session.close()
+		cls.stub.stop()
+
+	def check(self, thread):
+		comments = preorder(thread.comments)
+		self.assertEqual([c.name for c in comments], expected_preorder(self.stub))
+		self.assertEqual(thread.missing, [])
+		for c in comments:
+			parent = self.stub.parents[int(c.id, 36)]
+			self.assertEqual(c.parent_id, "t1_" + b36(parent) if parent else "t3_bench")
+			for r in c.replies:
+				self.assertEqual(r.parent_id, c.name)
+		for c in thread.comments:
+			self.assertEqual(c.parent_id, "t3_bench")
+
+	def test_complete_and_ordered(self):
+		self.check(self.session.get_thread("bench"))
+
+	def test_complete_and_ordered_workers(self):
+		self.check(self.session.get_thread("bench", workers=4))
+
+	def test_flat_matches_tree(self):
+		thread = self.session.get_thread("bench")
+		flat = thread.flatten()
+		self.assertEqual(list(flat.names), [c.name for c in preorder(thread.comments)])
+		for row in range(len(flat)):
+			p = flat.parents[row]
+			self.assertEqual(flat[row].parent_id, flat.names[p] if p >= 0 else "t3_bench")
+
+class FlatThreadTest(unittest.TestCase):
+	def test_missing_fields(self):
+		session = make_session("http://127.0.0.1:9/")	#never sends anything
+		c = session._thing_factory({"kind":"t1", "data":{"name":"t1_a", "id":"a", "body":"", "parent_id":"t3_x", "link_id":"t3_x", "replies":""}})	#no score, created_utc or author
+		flat = lightreddit.FlatThread(session, None, [c])
+		self.assertEqual((flat.scores[0], flat.created[0], flat.author_names[flat.authors[0]]), (0, 0.0, None))
+
+class ThreadDeltaTest(unittest.TestCase):
+	def setUp(self):
+		self.stub = StubReddit(thread_size=1500, thread_shown=200, listing_size=10, flair_size=10)
+		self.session = make_session(self.stub.start())
+
+	def tearDown(self):
+		self.session.close()
+		self.stub.stop()
+
+	def test_refresh_fetches_missing(self):
+		thread = self.session.get_thread("bench", max_requests=2)
+		self.assertNotEqual(thread.missing, [])
+		thread.refresh()
+		self.assertEqual(thread.missing, [])
+		self.assertEqual(sorted(thread.get_index()), sorted(expected_preorder(self.stub)))
+
+	def test_refresh_recovers_failed_batches(self):
+		thread = self.session.get_thread("bench", max_requests=2)
+		fetch = self.session._fetch_morechildren
+		calls = []
+		def flaky(link_id, chunk):
+			calls.append(chunk)
+			if len(calls) > 3:
+				raise lightreddit.requests.ConnectionError("connection reset")
+			return fetch(link_id, chunk)
+		self.session._fetch_morechildren = flaky
+		thread.refresh()
+		self.assertNotEqual(thread.missing, [])
+		del self.session._fetch_morechildren
+		thread.refresh()
+		self.assertEqual(thread.missing, [])
+		self.assertEqual(sorted(thread.get_index()), sorted(expected_preorder(self.stub)))
+
+	def test_quiet_refresh_costs_one_request(self):
+		self.stub.deleted = set([i for i in range(400, 1500) if not self.stub.kids.get(i)][:20])	#hidden leaves that morechildren won't return, but stubs still count
+		thread = self.session.get_thread("bench")
+		self.assertEqual(sorted(thread.get_index()), sorted(expected_preorder(self.stub)))
+		requests = []
+		self.session.add_hook(requests.append)
+		for i in range(2):
+			del requests[:]
+			self.assertEqual(thread.refresh(), ([], []))
+			self.assertEqual(len(requests), 1)
+
+	def test_refresh_finds_replies_under_hidden_comments(self):
+		thread = self.session.get_thread("bench")
+		deep = 1400	#fetched through morechildren
+		self.assertIn("t1_" + b36(deep), thread.get_index())
+		new = [self.stub.add_comment(deep), self.stub.add_comment(1), self.stub.add_comment(0)]
+		added, changed = thread.refresh()
+		self.assertEqual(sorted(int(c.id, 36) for c in added), new)
+		self.assertIn(thread.index["t1_" + b36(new[0])], thread.index["t1_" + b36(deep)].replies)
+		self.assertEqual(thread.refresh(), ([], []))
+
+if __name__ == "__main__":
+	unittest.main()